@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Benchmark of the reservations under contention.
+
+Many users ask for the few items of a shared list at the same time.
+The requests are served in bursts, as the reactor would read them in
+one turn, first with Service.reserveItem, then with the claim table.
+
+For each path, the benchmark reports the throughput, the SQL
+statements and the transactions (commits and rollbacks) per request,
+and the fairness: the share of the items won by the first user who
+asked for them.
+
+Usage, from the top of the source tree:
+
+  python bench/reservations.py [--users N] [--items N] [--burst N]
+"""
+
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from souhaits import core  # pylint: disable-msg=C0413
+
+
+def legacy(srv, burst):
+    """Serve a burst with Service.reserveItem."""
+    for user, item in burst:
+        srv.reserveItem(user, item)
+
+
+def claims(srv, burst):
+    """Serve a burst with the claim table, written at the end of the turn."""
+    for user, item in burst:
+        srv.claims.reserve(user, item)
+    srv.claims.flush()
+
+
+def run(srv, name, serve, requests, size):
+    """Serve 'requests' by bursts of 'size', and print the results."""
+    srv.cx.execute('DELETE FROM reservation')
+    srv.cx.commit()
+
+    transactions = []
+
+    def _count(method):
+        """Count the calls to 'method' of the connection."""
+        def _counted():
+            transactions.append(method)
+            getattr(srv.cx.__class__, method)(srv.cx)
+        setattr(srv.cx, method, _counted)
+
+    _count('commit')
+    _count('rollback')
+    statements = srv.sql_statements
+    start = time.time()
+    try:
+        for i in xrange(0, len(requests), size):
+            serve(srv, requests[i:i + size])
+    finally:
+        del srv.cx.commit
+        del srv.cx.rollback
+    duration = time.time() - start
+    statements = srv.sql_statements - statements
+
+    first = {}
+    for user, item in requests:
+        first.setdefault(item.key, user.id)
+
+    cu = srv.cx.cursor()
+    cu.execute('SELECT item, owner FROM reservation')
+    holders = dict(cu.fetchall())
+
+    fair = sum(1 for k, u in first.items() if holders.get(k) == u)
+    print '%-8s %8.0f req/s %6.2f stmt/req %6.3f tx/req %5.1f%% first' % (
+        name, len(requests) / duration, float(statements) / len(requests),
+        float(len(transactions)) / len(requests), 100.0 * fair / len(first))
+
+
+def main():
+    """Run the benchmark."""
+    parser = optparse.OptionParser()
+    parser.add_option('--users', type='int', default=200,
+                      help='users asking for the items')
+    parser.add_option('--items', type='int', default=20,
+                      help='items of the shared list')
+    parser.add_option('--clicks', type='int', default=5,
+                      help='requests per user')
+    parser.add_option('--burst', type='int', default=50,
+                      help='requests served in one turn of the reactor')
+    parser.add_option('--seed', type='int', default=0)
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    srv = core.Service('http://localhost:7707', debug=False,
+                       background=False)
+    srv.startService()
+    try:
+        owner, _ = srv.createSessionUser()
+        lst = srv.createList(owner, u'classe')
+        srv.importItems(lst, [(u'idée %d' % i, u'', u'', 2)
+                              for i in xrange(options.items)])
+        items, _ = srv.itemsForListPage(lst, limit=options.items)
+        users = [srv.getUserByKey(srv.createSessionUser()[0].id)
+                 for _ in xrange(options.users)]
+
+        rand = random.Random(options.seed)
+        requests = [(user, rand.choice(items))
+                    for user in users for _ in xrange(options.clicks)]
+        rand.shuffle(requests)
+
+        print '%d requests by %d users on %d items, by bursts of %d' % (
+            len(requests), options.users, options.items, options.burst)
+        for name, serve in [('legacy', legacy), ('claims', claims)]:
+            run(srv, name, serve, requests, options.burst)
+    finally:
+        srv.stopService()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
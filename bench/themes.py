@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Benchmark of the theme fragments: list title and reservation lock.
+
+For each theme, the fragments are rendered as a list page renders them,
+once per item, first as stan built and flattened for each item, then
+from the templates flattened when the module is loaded.
+
+Usage, from the top of the source tree:
+
+  python bench/themes.py [--items N]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable-msg=C0413
+from nevow import flat, stan
+
+from souhaits.web import theme, widget
+
+
+def _substitute(tag, data):
+    """Return stan with the holes of 'tag' replaced by 'data'."""
+    if isinstance(tag, list):
+        return [_substitute(t, data) for t in tag]
+    if tag == widget.HOLE:
+        return data
+    if not isinstance(tag, stan.Tag):
+        return tag
+
+    clone = tag.clone(deep=False)
+    for name, value in clone.attributes.items():
+        if value == widget.HOLE:
+            clone.attributes[name] = data
+    clone.children = [_substitute(c, data) for c in tag.children]
+    return clone
+
+
+def stan_render(template, data):
+    """Build the stan of the fragment and flatten it."""
+    return flat.flatten(_substitute(template.tag, data))
+
+
+def flat_render(template, data):
+    """Fill the flattened template."""
+    return flat.flatten(template.fill(data))
+
+
+def measure(render, template, data, count):
+    """Return the time to render one item, in microseconds."""
+    start = time.time()
+    for _ in xrange(count):
+        render(template, data)
+    return (time.time() - start) * 1e6 / count
+
+
+def main():
+    """Run the benchmark."""
+    parser = optparse.OptionParser()
+    parser.add_option('--items', type='int', default=20000,
+                      help='fragments rendered per theme and method')
+    options, _ = parser.parse_args()
+
+    lock = u'réservé par quelqu\'un <ami@example.com>'
+    title = u'Liste de Noël & anniversaire'
+
+    print '%-8s %-6s %10s %10s %8s' % ('theme', 'part', 'stan us',
+                                       'flat us', 'speedup')
+    for key in sorted(theme.themes):
+        current = theme.themes[key]
+        for part, template, data in [('lock', current.lock, lock),
+                                     ('title', current.title, title)]:
+            assert stan_render(template, data) == flat_render(template, data)
+            slow = measure(stan_render, template, data, options.items)
+            fast = measure(flat_render, template, data, options.items)
+            print '%-8s %-6s %10.2f %10.2f %7.1fx' % (key, part, slow, fast,
+                                                      slow / fast)
+
+
+if __name__ == '__main__':
+    main()
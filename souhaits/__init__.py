@@ -4,6 +4,10 @@
 
 """
 import os
+import time
+
+# When the application started to load, for the startup report
+STARTED = time.time()
 
 _PREFIX = os.path.dirname(__file__)
 
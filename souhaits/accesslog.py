@@ -0,0 +1,102 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Structured access log.
+
+Each request is logged as one line of JSON. Lines are buffered in
+memory and written in batches from a thread, so that the reactor
+never waits on the disk. The file is rotated by size.
+"""
+
+import json
+import os
+
+from twisted.application import service
+from twisted.internet import task, threads
+from twisted.python import log, logfile
+
+
+class AccessLog(service.Service):
+    """Buffered, size-rotated JSON lines log file."""
+
+    # Seconds between two flushes of the buffer
+    FLUSH_PERIOD = 1.0
+
+    # Flush early when that many lines are pending
+    MAX_PENDING = 500
+
+    def __init__(self, path, rotate_length=10 * 1024 * 1024, max_files=10):
+        self.path = path
+        self.rotate_length = rotate_length
+        self.max_files = max_files
+
+        self.logfile = None
+        self.flush_task = None
+        self.pending = []
+        self.writing = None
+
+    def startService(self):
+        """Open the log file and start flushing periodically."""
+        service.Service.startService(self)
+
+        directory, name = os.path.split(os.path.abspath(self.path))
+        self.logfile = logfile.LogFile(name, directory,
+                                       rotateLength=self.rotate_length,
+                                       maxRotatedFiles=self.max_files)
+
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.FLUSH_PERIOD, now=False)
+
+    def stopService(self):
+        """Write the pending lines and close the file."""
+        service.Service.stopService(self)
+        self.flush_task.stop()
+
+        def _close(_):
+            self._write(self.pending)
+            self.pending = []
+            self.logfile.close()
+
+        if self.writing is not None:
+            return self.writing.addCallback(_close)
+        return _close(None)
+
+    def write(self, entry):
+        """Queue an entry (a dict) for writing."""
+        self.pending.append(json.dumps(entry, sort_keys=True,
+                                       separators=(',', ':')))
+
+        if len(self.pending) >= self.MAX_PENDING:
+            self.flush()
+
+    def _write(self, lines):
+        """Write lines to the log file (runs in a thread)."""
+        if lines:
+            self.logfile.write('\n'.join(lines) + '\n')
+            self.logfile.flush()
+
+    def flush(self):
+        """Write the pending lines, unless a write is in progress."""
+        if self.writing is not None or not self.pending:
+            return
+
+        lines, self.pending = self.pending, []
+
+        def _done(_):
+            self.writing = None
+
+        self.writing = threads.deferToThread(self._write, lines)
+        self.writing.addErrback(log.err).addCallback(_done)
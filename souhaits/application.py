@@ -19,35 +19,99 @@
 from twisted.application import service
 from twisted.application import internet
 
-from nevow import appserver, vhost
+from nevow import vhost
 
-from souhaits import core, pages
+from souhaits import accesslog, backup, core, maintenance, pages, startup
+from souhaits import workers as workers_
+from souhaits.web import admission, site as web_site
 
 PORT = 7707
 
-def prepare(debug):
-    """Bind together the webserver components.
+# Structured (JSON lines) access log, rotated by size
+ACCESS_LOG = '+access.log'
+
+# Access log of each worker process, by index
+ACCESS_LOG_WORKER = '+access-%d.log'
+
+# Daily snapshots of the database
+BACKUP_DIR = '+backups'
+
+# Page requests served at once by a process, beyond which they are
+# turned away, and how late the reactor may run (seconds). 0 disables.
+MAX_IN_FLIGHT = 32
+QUEUE_BUDGET = 0.5
+
+
+def base_url(debug):
+    """Return the public URL of the site."""
+    if debug:
+        return 'http://127.0.0.1:%d' % PORT
+    return 'http://mes-souhaits.net'
+
+
+def make_site(parent, debug, background=True, access_log=ACCESS_LOG,
+              max_in_flight=MAX_IN_FLIGHT, queue_budget=QUEUE_BUDGET):
+    """Create the database, access log and warm-up services and the site.
 
     Args:
+      parent: service.IServiceCollection the services are added to
       debug: bool, if True run in debug mode
-    
+      background: bool, if True run the periodic tasks in this process
+      access_log: str, path of the access log
+      max_in_flight: int, page requests served at once (0: no limit)
+      queue_budget: float, tolerated lag of the reactor (0: no limit)
+
     Returns:
-      service.Application
+      web_site.Site
     """
-    application = service.Application("mes-souhaits")
+    startup.PHASES.mark('imports')
 
-    if debug:
-        url = 'http://127.0.0.1:%d' % PORT
-    else:
-        url = 'http://mes-souhaits.net'
+    srv = core.Service(base_url(debug), debug=debug, background=background)
+    srv.setServiceParent(parent)
 
-    srv = core.Service(url, debug=debug)    
-    srv.setServiceParent(application)
+    if background:
+        backups = backup.Backup(BACKUP_DIR)
+        backups.setServiceParent(parent)
+        maintenance.Maintenance(srv).setServiceParent(parent)
 
     root = pages.RootPage(srv)
     root.putChild('vhost', vhost.VHostMonsterResource())
     
-    site = appserver.NevowSite(root)
+    log_service = accesslog.AccessLog(access_log)
+    log_service.setServiceParent(parent)
+
+    # Started after the database, before the caller listens
+    startup.WarmUp(srv).setServiceParent(parent)
+
+    site = web_site.Site(root, srv, log_service, admission.Admission(
+        max_in_flight, queue_budget))
+    startup.PHASES.mark('site')
+    return site
+
+
+def prepare(debug, workers=0, max_in_flight=MAX_IN_FLIGHT,
+            queue_budget=QUEUE_BUDGET):
+    """Bind together the webserver components.
+
+    Args:
+      debug: bool, if True run in debug mode
+      workers: int, if not 0 serve from that many processes
+      max_in_flight: int, page requests served at once by a process
+      queue_budget: float, seconds a request may wait for the reactor
+    
+    Returns:
+      service.Application
+    """
+    application = service.Application("mes-souhaits")
+
+    if workers:
+        pool = workers_.WorkerPool(PORT, workers, debug, max_in_flight,
+                                   queue_budget)
+        pool.setServiceParent(application)
+        return application
+
+    site = make_site(application, debug, max_in_flight=max_in_flight,
+                     queue_budget=queue_budget)
 
     server = internet.TCPServer(PORT, site)  # pylint: disable-msg=E1101
     server.setServiceParent(application)
@@ -0,0 +1,130 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Online backups of the database.
+
+The database is copied periodically while the server runs, with
+VACUUM INTO, which writes a compact copy in one go. The copy is made
+from a thread, on its own connection, so the reactor never waits on
+it; in WAL mode the copy reads a snapshot and does not hold back the
+writer.
+
+A server restarted more often than 'period' would never reach the
+first tick: at start, a backup is made if the newest snapshot is
+older than 'period'.
+"""
+
+import glob
+import os
+import time
+
+from twisted.application import service
+from twisted.internet import task, threads
+from twisted.python import log
+
+from souhaits import core, metrics
+
+
+class Backup(service.Service):
+    """Periodic, rotated snapshots of the database.
+
+    Args:
+      directory: str, where the snapshots are written
+      keep: int, number of snapshots kept
+      period: float, seconds between two backups
+    """
+
+    PREFIX = 'mes-souhaits-'
+
+    def __init__(self, directory, keep=7, period=24 * 3600):
+        self.directory = directory
+        self.keep = keep
+        self.period = period
+        self.task = None
+        self.pending = None
+
+    def startService(self):
+        """Start backing up periodically."""
+        service.Service.startService(self)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        snapshots = self.snapshots()
+        overdue = (not snapshots or
+                   os.path.getmtime(snapshots[-1]) < time.time() - self.period)
+
+        self.task = task.LoopingCall(self.run)
+        self.task.start(self.period, now=overdue)
+
+    def stopService(self):
+        """Stop the backups, waiting for the current one."""
+        service.Service.stopService(self)
+        if self.task.running:
+            self.task.stop()
+        return self.pending
+
+    def snapshots(self):
+        """Return the paths of the snapshots, oldest first."""
+        return sorted(glob.glob(os.path.join(
+            self.directory, self.PREFIX + '*.db')))
+
+    def _copy(self, path):
+        """Copy the database to 'path' (runs in a thread)."""
+        temporary = path + '.tmp'
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+
+        source = core.sqlite.connect(core.DB_FILE)
+        try:
+            source.execute('VACUUM INTO ?', (temporary,))
+        finally:
+            source.close()
+
+        os.rename(temporary, path)
+        return os.path.getsize(path)
+
+    def _rotate(self):
+        """Remove the oldest snapshots."""
+        for path in self.snapshots()[:-self.keep]:
+            log.msg('removing backup %s' % path)
+            os.unlink(path)
+
+    def run(self):
+        """Start a backup, unless one is running already."""
+        if self.pending is not None:
+            return self.pending
+
+        path = os.path.join(self.directory, self.PREFIX + time.strftime(
+            '%Y%m%d-%H%M%S.db'))
+        start = time.time()
+
+        def _done(size):
+            duration = time.time() - start
+            metrics.BACKUP_SECONDS.observe(duration)
+            metrics.BACKUP_BYTES.set(size)
+            log.msg('backup %s: %d bytes in %.1f s' % (path, size, duration))
+            self._rotate()
+
+        def _failed(failure):
+            metrics.BACKUP_FAILURES.inc()
+            log.err(failure, 'backup %s failed' % path)
+
+        def _finally(_):
+            self.pending = None
+
+        self.pending = threads.deferToThread(self._copy, path)
+        self.pending.addCallbacks(_done, _failed).addBoth(_finally)
+        return self.pending
@@ -0,0 +1,180 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""In-process caches, kept coherent across processes.
+
+Every change to a list bumps its version in the list_version table,
+and every change to the lists shown to a user bumps the version of
+the user in user_version (see schema.py). Before answering from a
+cache, a process catches up with the versions changed since it last
+looked: PRAGMA data_version tells cheaply whether anything was
+committed at all, and the index on the versions gives the lists that
+changed.
+"""
+
+from souhaits import metrics
+
+
+class Versions(object):
+    """The versions of the lists, as last seen by this process.
+
+    Args:
+      srv: core.Service, used to open the watching connection
+    """
+
+    def __init__(self, srv):
+        self.srv = srv
+        self.watcher = None
+        self.data_version = None
+        self.high = 0
+        self.versions = {}
+        self.user_high = 0
+        self.users = {}
+
+    def refresh(self):
+        """Catch up with the changes committed by any process."""
+        # The watcher is a separate connection: data_version only
+        # changes for the commits made by the other connections,
+        # including the service's own.
+        if self.watcher is None:
+            self.watcher = self.srv.connect()
+
+        cu = self.watcher.cursor()
+        cu.execute('PRAGMA data_version')
+        row = cu.fetchone()
+        if row is not None:
+            if row[0] == self.data_version:
+                return
+            self.data_version = row[0]
+
+        cu.execute('SELECT list, version FROM list_version WHERE version > ?',
+                   (self.high,))
+        for lst, version in cu.fetchall():
+            self.versions[lst] = version
+            self.high = max(self.high, version)
+
+        cu.execute('SELECT user, version FROM user_version WHERE version > ?',
+                   (self.user_high,))
+        for user, version in cu.fetchall():
+            self.users[user] = version
+            self.user_high = max(self.user_high, version)
+
+    def get(self, lst):
+        """Return the version of list 'lst' (a key) as of the last refresh."""
+        return self.versions.get(lst, 0)
+
+    def get_user(self, user):
+        """Return the version of user 'user' (a key) as of the last refresh."""
+        return self.users.get(user, 0)
+
+    def close(self):
+        """Close the watching connection."""
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+
+class VersionedCache(object):
+    """Cache of values depending on a single list.
+
+    An entry is only returned while the version of its list is the
+    one it was stored with.
+
+    Args:
+      versions: Versions
+      name: str, name of the cache in the metrics
+      size: int, the cache is emptied when it grows larger
+    """
+
+    def __init__(self, versions, name, size=1000):
+        self.versions = versions
+        self.name = name
+        self.size = size
+        self.entries = {}
+
+    def get(self, key):
+        """Return the value stored for 'key', or None."""
+        self.versions.refresh()
+
+        entry = self.entries.get(key)
+        hit = (entry is not None and
+               self.versions.get(entry[0]) == entry[1])
+        metrics.cache_lookup(self.name, hit)
+
+        if hit:
+            return entry[2]
+        return None
+
+    def put(self, key, lst, value, version=None):
+        """Store 'value' for 'key', depending on list 'lst' (a key).
+
+        'version' is the version of the list the value was computed
+        from. It defaults to the one seen by the last lookup, which is
+        only right when nothing was looked up since the value was read.
+        """
+        if len(self.entries) >= self.size:
+            self.entries.clear()
+
+        if version is None:
+            version = self.versions.get(lst)
+        self.entries[key] = (lst, version, value)
+
+
+class UserCache(object):
+    """Cache of values depending on a user and on some lists.
+
+    An entry is only returned while the version of its user and the
+    versions of all its lists are the ones it was stored with.
+
+    Args:
+      versions: Versions
+      name: str, name of the cache in the metrics
+      size: int, the cache is emptied when it grows larger
+    """
+
+    def __init__(self, versions, name, size=1000):
+        self.versions = versions
+        self.name = name
+        self.size = size
+        self.entries = {}
+
+    def get(self, user):
+        """Return the value stored for 'user' (a key), or None."""
+        versions = self.versions
+        versions.refresh()
+
+        entry = self.entries.get(user)
+        hit = (entry is not None and
+               versions.get_user(user) == entry[0] and
+               all(versions.get(lst) == version for lst, version in entry[1]))
+        metrics.cache_lookup(self.name, hit)
+
+        if hit:
+            return entry[2]
+        return None
+
+    def put(self, user, lsts, value):
+        """Store 'value' for 'user', depending on lists 'lsts' (keys)."""
+        if len(self.entries) >= self.size:
+            self.entries.clear()
+
+        # As in VersionedCache, the versions are the ones seen by the
+        # last lookup.
+        versions = self.versions
+        self.entries[user] = (
+            versions.get_user(user),
+            [(lst, versions.get(lst)) for lst in lsts],
+            value)
@@ -19,9 +19,6 @@
 
 Provides database calls, entities,...
 """
-from email import Header  # pylint: disable-msg=E0611
-from email import MIMEText  # pylint: disable-msg=E0611
-
 import md5
 import random
 import string  # pylint: disable-msg=W0402
@@ -34,11 +31,11 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite
 
 from twisted.application import service
-from twisted.mail import smtp
-from twisted.internet import task
+from twisted.internet import reactor, task
 from twisted.python import log
 from zope.interface import implements, Interface  # pylint: disable-msg=F0401
 
+from souhaits import cache, metrics, querylog, reservation, schema, startup
 from souhaits.web import theme
 
 # This dict will map some accented letters to their non-accented
@@ -71,9 +68,13 @@ def _make_cookie():
             str(random.random()),
             str(time.time()))).hexdigest()
 
+# The database file, relative to the server's directory
+DB_FILE = '+mes-souhaits.db'
+
 # Reserved wishlist names
 RESERVED = frozenset(('newlist', 'login', 'logout', 'challenge', 'invite',
-                      'css', 'images', 'js', 'themes', 'about', 'help'))
+                      'css', 'images', 'js', 'themes', 'about', 'help',
+                      'metrics', 'api', 'export', 'search', 'admin'))
 
 
 def hours_ago(hours):
@@ -125,6 +126,24 @@ def _validate_url(cursor, url):
     return url
 
 
+# Markers of the matches in the search snippets
+SNIPPET_START = u'\x02'
+SNIPPET_END = u'\x03'
+
+
+def fts_query(text):
+    """Turn the words typed by a user into a full-text query.
+
+    Every word must appear, possibly as the prefix of a longer one.
+    The FTS syntax itself is not available, so that any text is a
+    valid query. Returns None when there is no word at all.
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return u' '.join([u'"%s"*' % w for w in words])
+
+
 def validate_email(address):
     """Cleanup an email address. Return None if the address is invalid."""
     address = address.replace(' ', '').lower()
@@ -198,6 +217,69 @@ class Item(object):
         return 'Item %s' % repr (self.__dict__)
 
 
+class ListEvent(object):
+    """A change made to a list, as logged in list_event.
+
+    The kind is one of:
+      c, u, d: item created, updated, deleted
+      r, g, D: item reserved, given up, donated
+      l: list edited (name, URL, description,...)
+
+    Reservation events must not be shown to the owners of the list.
+    """
+
+    def __init__(self, seq, at, list_id, item, kind):
+        self.seq  = seq
+        self.at   = at
+        self.list = list_id
+        self.item = item
+        self.kind = kind
+
+    def __repr__(self):
+        return 'ListEvent %s' % repr(self.__dict__)
+
+
+class _Cursor(sqlite.Cursor):
+    """Cursor reporting every statement to its connection's observers."""
+
+    def execute(self, sql, params=()):
+        """Execute a statement and time it."""
+        start = time.time()
+        try:
+            return sqlite.Cursor.execute(self, sql, params)
+        finally:
+            self.connection.observe(sql, params, time.time() - start)
+
+    def executemany(self, sql, seq_of_params):
+        """Execute a statement repeatedly and time it."""
+        start = time.time()
+        try:
+            return sqlite.Cursor.executemany(self, sql, seq_of_params)
+        finally:
+            self.connection.observe(sql, None, time.time() - start)
+
+
+class _Connection(sqlite.Connection):
+    """Database connection handing out instrumented cursors.
+
+    Observers are called with (sql, params, duration) after each
+    statement.
+    """
+
+    def __init__(self, *args, **kw):
+        sqlite.Connection.__init__(self, *args, **kw)
+        self.observers = []
+
+    def cursor(self, factory=_Cursor):
+        """Return a new cursor."""
+        return sqlite.Connection.cursor(self, factory)
+
+    def observe(self, sql, params, duration):
+        """Notify the observers that a statement has been run."""
+        for observer in self.observers:
+            observer(sql, params, duration)
+
+
 class IService(Interface):  # pylint: disable-msg=W0232
     """The service interface describes all database operations."""
 
@@ -207,29 +289,139 @@ class Service(service.Service):
     implements(IService)
 
     GC_PERIOD = 3600 * 8
+
+    # The first GC runs that long (seconds) after the start, once the
+    # first requests have been served
+    GC_DELAY = 60
+
+    # Most recently modified lists loaded in the cache by the warm-up
+    WARM_LISTS = 50
+
+    # The statistics counted in memory are written that often (seconds)
+    STATS_PERIOD = 60
+
+    # List events are kept that many days
+    EVENT_RETENTION = 60
     ADMIN = 'webmaster@mes-souhaits.net'
+
+    # Statements slower than this (in seconds) are logged
+    SLOW_QUERY = 0.05
     
-    def __init__ (self, base_url, debug=True):
+    def __init__ (self, base_url, debug=True, background=True):
+        """Create the service.
+
+        Args:
+          base_url: str, public URL of the site
+          debug: bool, if True mails are written to +mailbox
+          background: bool, if False the periodic tasks (GC,...) are
+            left to another process sharing the database
+        """
         self.base_url = base_url
         self.gc_task = None
+        self.gc_call = None
+        self.stats_task = None
+        self.stats = {}
         self.cx = None
         self.debug = debug
+        self.background = background
+
+        # Running totals, also added to the cost of the request being
+        # served, if any (see web.site.Request)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.mail_seconds = 0.0
+        self.account = None
+        self.querylog = querylog.QueryLog(self, self.SLOW_QUERY)
+
+        # Lists, by URL and by key, valid across processes
+        self.versions = cache.Versions(self)
+        self.list_cache = cache.VersionedCache(self.versions, 'wishlist')
+
+        # Lists in the sidebar, by user
+        self.sidebar_cache = cache.UserCache(self.versions, 'sidebar')
+
+        # List pages as rendered for the guests, by list and URL
+        self.guest_pages = cache.VersionedCache(self.versions, 'guest_page',
+                                                size=100)
+
+        # Reservations decided in memory, written in batches
+        self.claims = reservation.Claims(self)
+
+    def _count_sql(self, _sql, _params, duration):
+        """Keep track of the statements run on the connection."""
+        self.sql_statements += 1
+        self.sql_seconds += duration
+        if self.account is not None:
+            self.account.sql_statements += 1
+            self.account.sql_seconds += duration
 
     def startService(self):
         """Start the web service (database, GC task)."""
         log.msg('starting souhaits db, debug=%r' % (self.debug,))
+        startup.PHASES.mark('launch')
 
         self.gc_task = task.LoopingCall(self.garbageCollector)
-        self.cx = sqlite.connect('+mes-souhaits.db')
+        self.stats_task = task.LoopingCall(self.flushStats)
+        self.cx = sqlite.connect(DB_FILE, factory=_Connection)
+        self.cx.observers.append(self._count_sql)
+        self.cx.observers.append(self.querylog)
 
         cu = self.cx.cursor ()
+
+        # Several processes may share the database: let the readers
+        # proceed while one of them writes.
+        cu.execute ('PRAGMA journal_mode = WAL')
+
         cu.execute ("SELECT COUNT (tbl_name) FROM sqlite_master")
+        if cu.fetchone () [0] == 0:
+            self._create_database(cu)
 
-        if cu.fetchone () [0] > 0:
-            self.garbageCollector ()
-            self.gc_task.start (self.GC_PERIOD)
-            return
-        
+        schema.upgrade(self.cx)
+
+        self.stats_task.start(self.STATS_PERIOD, now=False)
+
+        if self.background:
+            self.gc_call = reactor.callLater(self.GC_DELAY, self._startGC)
+
+        startup.PHASES.mark('database')
+
+    def _startGC(self):
+        """Run the GC now, without the repairs, and then every GC_PERIOD."""
+        self.gc_call = None
+        self.garbageCollector(repair=False)
+        self.gc_task.start(self.GC_PERIOD, now=False)
+
+    def warmUp(self):
+        """Prepare the statements of the common pages and fill the caches.
+
+        The statements are run once with keys that match nothing: the
+        connection keeps them compiled, and the first pages of the
+        indices they use are read from the disk.
+        """
+        self.versions.refresh()
+
+        nobody = User(0, None)
+        nolist = Wishlist(0, None, None, None, 0, 0)
+        self.getSessionUser('')
+        self.getUserByKey(0)
+        self.getListByURL('')
+        self.getListsOwnedBy(nobody)
+        self.getFriendLists(nobody)
+        self.itemsForViewer(nolist, nobody)
+        self.itemsForListPage(nolist, with_reservations=True)
+        self.listCounters(nolist)
+        self.reservationHolder(Item(0, 0, None, None, None, 0))
+        self.reservationHolders(0)
+
+        cu = self.cx.cursor()
+        cu.execute('SELECT key, name, url, description, owner, showres, theme'
+                   ' FROM wishlist ORDER BY modification DESC LIMIT ?', (
+            self.WARM_LISTS,))
+        for r in cu.fetchall():
+            self._remember_list(Wishlist(*r))
+
+    def _create_database(self, cu):
+        """Create the tables of a new database."""
         log.msg ('starting a new database')
 
         # A session is the permanent object that identifies a given
@@ -395,55 +587,157 @@ class Service(service.Service):
         """)
         
         self.cx.commit()
-
-        self.gc_task.start (self.GC_PERIOD)
         return
 
     
     def stopService(self):
         """Stop the service."""
         log.msg ('stopping souhaits db')
-        self.gc_task.stop ()
+        if self.gc_call is not None:
+            self.gc_call.cancel()
+            self.gc_call = None
+        if self.gc_task.running:
+            self.gc_task.stop ()
+        if self.stats_task.running:
+            self.stats_task.stop()
+        self.claims.flush()
+        self.flushStats()
+        self.querylog.report()
+        self.querylog.close()
+        self.versions.close()
+        self.cx.close()
         return
 
-    def garbageCollector(self):
-        """Clean old sessions, pending users,..."""
+    def connect(self):
+        """Open a new, independent connection to the database."""
+        return sqlite.connect(DB_FILE)
+
+    def garbageCollector(self, repair=True):
+        """Clean old sessions, pending users,...
+
+        Args:
+          repair: bool, if True also repair the counters of the lists,
+            which reads all the items, reservations and followers
+        """
+        start = time.time()
         cu = self.cx.cursor()
 
         # Drop sessions older than 6 months
         cu.execute ('DELETE FROM session WHERE activity < ?', (
             hours_ago(24 * 180),))
+        metrics.GC_ROWS.inc('session', amount=cu.rowcount)
 
         # Discard users that did not manage to identify themselves in
         # 7 days
         cu.execute ('DELETE FROM user WHERE email IS NULL AND creation < ?', (
             hours_ago(7 * 24),))
+        metrics.GC_ROWS.inc('user', amount=cu.rowcount)
 
         # Discard challenges that did not manage to identify
         # themselves in 7 days
         cu.execute ('DELETE FROM challenge WHERE creation < ? AND NOT active', (
             hours_ago(7 * 24),))
+        metrics.GC_ROWS.inc('challenge', amount=cu.rowcount)
 
         # Discard items from confirmed reservations older than one month
         cu.execute("DELETE FROM item WHERE key IN ("
                    "SELECT j.key FROM item j, reservation r WHERE "
                    "j.key = r.item AND r.status = 'D' AND "
                    "r.confirmation < ?)", (hours_ago(24*30),))
+        metrics.GC_ROWS.inc('item', amount=cu.rowcount)
+
+        # Trim the list events. They are stored in time order, so the
+        # scan stops at the first one to keep.
+        cu.execute('DELETE FROM list_event WHERE seq < IFNULL('
+                   '(SELECT seq FROM list_event WHERE at >= ?'
+                   ' ORDER BY seq LIMIT 1),'
+                   ' (SELECT MAX(seq) + 1 FROM list_event))', (
+            int(time.time()) - self.EVENT_RETENTION * 24 * 3600,))
+        metrics.GC_ROWS.inc('list_event', amount=cu.rowcount)
 
         self.cx.commit()
+
+        # The counters are maintained by triggers: this only catches
+        # the changes made behind their back.
+        if repair:
+            self.repairCounters()
+
+        metrics.GC_SECONDS.observe(time.time() - start)
+        self.querylog.report()
         return
 
+    def countStat(self, name, amount=1):
+        """Count 'amount' more for statistic 'name' of today.
+
+        The counts are kept in memory and written every STATS_PERIOD,
+        so that counting never opens a transaction of its own.
+        """
+        self.stats[name] = self.stats.get(name, 0) + amount
+
+    def setStat(self, name, value):
+        """Set statistic 'name' of today to 'value', a measure."""
+        self.cx.execute('INSERT OR REPLACE INTO daily_stats (day, name, value)'
+                        " VALUES (date('now'), ?, ?)", (name, value))
+        self.cx.commit()
+
+    def flushStats(self):
+        """Write the statistics counted in memory."""
+        if not self.stats:
+            return
+
+        stats, self.stats = self.stats, {}
+        cu = self.cx.cursor()
+        for name, amount in sorted(stats.items()):
+            cu.execute("INSERT OR IGNORE INTO daily_stats (day, name, value)"
+                       " VALUES (date('now'), ?, 0)", (name,))
+            cu.execute("UPDATE daily_stats SET value = value + ?"
+                       " WHERE day = date('now') AND name = ?", (amount, name))
+        self.cx.commit()
+
+    def dailyStats(self, days=30):
+        """Return the statistics of the last 'days' days.
+
+        Returns:
+          (list of (day, {name: value}), most recent first,
+           {name: value} of the running totals)
+        """
+        self.flushStats()
+
+        cu = self.cx.cursor()
+        cu.execute("SELECT day, name, value FROM daily_stats"
+                   " WHERE day >= date('now', ?) ORDER BY day DESC",
+                   ('-%d days' % (days - 1),))
+        by_day = []
+        for day, name, value in cu.fetchall():
+            if not by_day or by_day[-1][0] != day:
+                by_day.append((day, {}))
+            by_day[-1][1][name] = value
+
+        cu.execute("SELECT name, value FROM daily_stats WHERE day = ''")
+        return by_day, dict(cu.fetchall())
+
     def sendmail(self, _from, recipient, body):
         """Send an email message."""
+        self.countStat('mails')
         if self.debug:
+            metrics.MAILS.inc('mailbox')
             open('+mailbox', 'a').write(body)
         else:
+            # Only needed when mails are sent: not loaded at startup
+            from twisted.mail import smtp
+
+            metrics.MAILS.inc('smtp')
             smtp.sendmail('localhost', _from, recipient, body)
 
     def build_and_send(self, recipient, subject, body,
                        from_name=u'Mes souhaits',
                        from_email=None):
         """Compose an email and send it."""
+        # pylint: disable-msg=E0611
+        from email import Header, MIMEText
+
+        start = time.time()
+
         # pylint: disable-msg=E1101
         msg = MIMEText.MIMEText(body.encode('utf-8'))
 
@@ -464,6 +758,11 @@ class Service(service.Service):
         msg.set_charset('utf-8')
         self.sendmail(from_email, [recipient], msg.as_string())
 
+        duration = time.time() - start
+        self.mail_seconds += duration
+        if self.account is not None:
+            self.account.mail_seconds += duration
+
     def createSessionUser(self):
         """Create a website user."""
         cookie = _make_cookie ()
@@ -639,29 +938,59 @@ Votre webmaster@mes-souhaits.net
 
         return [User(*r) for r in cu.fetchall()]
 
-    def getListByURL (self, url):
-        """Get a list by its URL fragment."""
+    def _cached_list(self, column, value):
+        """Get a list by the value of a unique column, through the cache."""
+        lst = self.list_cache.get((column, value))
+        if lst is not None:
+            return lst
+
         cu = self.cx.cursor()
-        cu.execute ('SELECT key, name, url, description, owner, showres, theme'
-                    ' FROM wishlist WHERE url = ?', (url,))
+        cu.execute('SELECT key, name, url, description, owner, showres, theme'
+                   ' FROM wishlist WHERE %s = ?' % column, (value,))
 
-        r = cu.fetchall()
+        r = cu.fetchall ()
         if not r:
             return None
 
-        return Wishlist(*r[0])
+        lst = Wishlist(*r[0])
+        self.list_cache.put((column, value), lst.id, lst)
+        return lst
+
+    def _remember_list(self, lst):
+        """Put a list just read from the database in the cache."""
+        self.list_cache.put(('key', lst.id), lst.id, lst)
+        self.list_cache.put(('url', lst.url), lst.id, lst)
+
+    def getListByURL (self, url):
+        """Get a list by its URL fragment."""
+        return self._cached_list('url', url)
 
     def getListByKey (self, key):
         """Get a list by its ID."""
-        cu = self.cx.cursor()
-        cu.execute('SELECT key, name, url, description, owner, showres, theme'
-                   ' FROM wishlist WHERE key = ?', (key,))
+        return self._cached_list('key', key)
 
-        r = cu.fetchall ()
-        if not r:
-            return None
+    def eventsSince(self, seq, lst=None, limit=100):
+        """Return the events logged after 'seq', oldest first.
+
+        Args:
+          seq: int, sequence number of the last event already seen (0
+            for all of them)
+          lst: Wishlist or None, to only return the events of that list
+          limit: int, maximum number of events returned
+
+        Returns:
+          list of ListEvent
+        """
+        cu = self.cx.cursor()
+        if lst is None:
+            cu.execute('SELECT seq, at, list, item, kind FROM list_event'
+                       ' WHERE seq > ? ORDER BY seq LIMIT ?', (seq, limit))
+        else:
+            cu.execute('SELECT seq, at, list, item, kind FROM list_event'
+                       ' WHERE list = ? AND seq > ? ORDER BY seq LIMIT ?', (
+                lst.id, seq, limit))
 
-        return Wishlist(*r[0])
+        return [ListEvent(*r) for r in cu.fetchall()]
 
     def getSessionUser(self, cookie):
         """Get a user by its cookie."""
@@ -715,7 +1044,7 @@ Votre webmaster@mes-souhaits.net
         """Add a wishlist to the favorites of a user."""
         cu = self.cx.cursor ()
 
-        cu.execute('UPDATE friend SET visit = CURRENT_TIMESTAMP '
+        cu.execute('UPDATE friend SET visit = CURRENT_TIMESTAMP, unread = 0 '
                     'WHERE list = ? AND user = ?', (
             lst.id, user.id))
 
@@ -737,15 +1066,36 @@ Votre webmaster@mes-souhaits.net
         self.cx.commit ()
 
     def getFriendLists (self, user):
-        """Returh the favorite lists of 'user'."""
+        """Return the favorite lists of 'user'.
+
+        Returns:
+          list of (Wishlist, number of items changed since the last visit)
+        """
         cu = self.cx.cursor()
-        cu.execute('SELECT w.modification, f.visit, w.key, w.name, w.url,'
-                   ' w.description, w.owner, w.showres, w.theme FROM'
-                   ' wishlist w, friend f'
-                   ' WHERE w.key = f.list AND f.user = ?', (
-            user.id,))
+        cu.execute('SELECT w.key, w.name, w.url, w.description, w.owner,'
+                   ' w.showres, w.theme, f.unread FROM wishlist w, friend f'
+                   ' WHERE w.key = f.list AND f.user = ?', (user.id,))
 
-        return [(Wishlist(*r[2:]), r[0] > r[1]) for r in cu.fetchall()]
+        lsts = []
+        for r in cu.fetchall():
+            lst = Wishlist(*r[:7])
+            self._remember_list(lst)
+            lsts.append((lst, r[7]))
+        return lsts
+
+    def getSidebar(self, user):
+        """Return the lists shown in the sidebar of 'user'.
+
+        Returns:
+          (lists owned, as getListsOwnedBy,
+           lists followed, as getFriendLists)
+        """
+        sidebar = self.sidebar_cache.get(user.id)
+        if sidebar is None:
+            sidebar = self.getListsOwnedBy(user), self.getFriendLists(user)
+            self.sidebar_cache.put(user.id, [
+                lst.id for lst, _ in sidebar[0] + sidebar[1]], sidebar)
+        return sidebar
 
     def itemsForList(self, lst, with_reservations=False):
         """Return the items comprising a list.
@@ -774,6 +1124,180 @@ Votre webmaster@mes-souhaits.net
         
         return items
 
+    def itemsForListPage(self, lst, after=None, limit=50,
+                         with_reservations=False, hide_reserved=False,
+                         viewer=None):
+        """Return a page of the items of a list.
+
+        Items come in the order of itemsForList, the ties being broken
+        by key.
+
+        Args:
+          lst: Wishlist
+          after: (score, modification, key) of the last item of the
+            previous page, or None for the first page
+          limit: int, maximum number of items
+          with_reservations: bool, if True fill in the 'res' member
+          hide_reserved: bool, if True skip the items reserved by
+            someone else than 'viewer'
+          viewer: int or None, key of the user looking at the list
+
+        Returns:
+          (list of Item, cursor of the next page or None)
+        """
+        q = ['SELECT i.key, i.list, i.title, i.description, i.url, i.score,'
+             ' i.modification, r.owner, r.status, u.email'
+             ' FROM item i LEFT JOIN reservation r ON r.item = i.key'
+             ' LEFT JOIN user u ON u.key = r.owner'
+             " WHERE i.list = ? AND (r.status IS NULL OR r.status <> 'D')"]
+        params = [lst.id]
+
+        if hide_reserved:
+            q.append(' AND (r.status IS NULL OR r.owner = ?)')
+            params.append(viewer)
+
+        # Items with no score come last (NULL is the smallest value)
+        if after is not None:
+            score, modification, key = after
+            later = ('(i.modification < ? OR (i.modification = ? AND'
+                     ' i.key < ?))')
+            if score is None:
+                q.append(' AND i.score IS NULL AND ' + later)
+                params += [modification, modification, key]
+            else:
+                q.append(' AND (i.score < ? OR i.score IS NULL OR'
+                         ' (i.score = ? AND ' + later + '))')
+                params += [score, score, modification, modification, key]
+
+        q.append(' ORDER BY i.score DESC, i.modification DESC, i.key DESC'
+                 ' LIMIT ?')
+        params.append(limit + 1)
+
+        cu = self.cx.cursor ()
+        cu.execute(''.join(q), params)
+        rows = cu.fetchall()
+
+        items = []
+        for r in rows[:limit]:
+            item = Item(*r[:6])
+            if with_reservations and r[8] is not None:
+                item.res = (r[7], r[8], r[9])
+            items.append(item)
+
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            return items, (last[5], last[6], last[0])
+        return items, None
+
+    def itemsForViewer(self, lst, user, after=None, limit=50):
+        """Return a page of the items of a list, as 'user' may see them.
+
+        The managers of the list see all the items, and who reserved
+        them if the list shows the reservations. The other users do
+        not see the items reserved by someone else, and only know
+        whether the others are reserved.
+
+        Args:
+          lst: Wishlist
+          user: User, or None for an anonymous visitor
+          after: cursor returned for the previous page, or None
+          limit: int, maximum number of items
+
+        Returns:
+          (list of Item, cursor of the next page or None)
+        """
+        editable = user is not None and self.managesList(user, lst)
+
+        items, after = self.itemsForListPage(
+            lst, after, limit, not editable or lst.showres,
+            hide_reserved=not editable, viewer=user and user.id)
+
+        if not editable:
+            for i in items:
+                if i.res:
+                    i.res = (i.res [0], i.res [1], None)
+        return items, after
+
+    def _search_scope(self):
+        """Return the SQL of the lists a user (:user) can search.
+
+        Its rows are (list, manager), manager being 1 when the user
+        can edit the list.
+        """
+        return ('SELECT list, MAX(manager) AS manager FROM ('
+                'SELECT key AS list, 1 AS manager FROM wishlist'
+                ' WHERE owner = :user'
+                ' UNION ALL SELECT list, 1 FROM coeditor WHERE user = :user'
+                ' UNION ALL SELECT list, 0 FROM friend WHERE user = :user'
+                ') GROUP BY list')
+
+    def searchLists(self, user, query, limit=10):
+        """Search the lists 'user' owns, co-edits or follows.
+
+        Args:
+          user: User
+          query: unicode, words to look for
+          limit: int, maximum number of lists
+
+        Returns:
+          list of Wishlist, best match first
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+
+        cu = self.cx.cursor()
+        cu.execute('SELECT w.key, w.name, w.url, w.description, w.owner,'
+                   ' w.showres, w.theme FROM wishlist_fts f, wishlist w'
+                   ' WHERE wishlist_fts MATCH :match AND w.key = f.rowid'
+                   ' AND w.key IN (SELECT list FROM (%s))'
+                   ' ORDER BY f.rank LIMIT :limit' % self._search_scope(), {
+            'match': match, 'user': user.id, 'limit': limit})
+
+        return [Wishlist(*r) for r in cu.fetchall()]
+
+    def searchItems(self, user, query, offset=0, limit=20):
+        """Search the items of the lists 'user' owns, co-edits or follows.
+
+        The items the user cannot see on the list page (donated, or
+        reserved by someone else in a list the user does not manage)
+        are left out.
+
+        Args:
+          user: User
+          query: unicode, words to look for
+          offset: int, number of results to skip
+          limit: int, maximum number of items
+
+        Returns:
+          list of (Item, Wishlist, snippet of the description), best
+          match first. In the snippet, the matches are enclosed in
+          SNIPPET_START and SNIPPET_END.
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+
+        cu = self.cx.cursor()
+        cu.execute('SELECT i.key, i.list, i.title, i.description, i.url,'
+                   ' i.score, w.key, w.name, w.url, w.description, w.owner,'
+                   ' w.showres, w.theme,'
+                   ' snippet(item_fts, 1, :start, :end, :dots, 12)'
+                   ' FROM item_fts f, item i, (%s) s, wishlist w'
+                   ' LEFT JOIN reservation r ON r.item = i.key'
+                   ' WHERE item_fts MATCH :match AND i.key = f.rowid'
+                   ' AND s.list = i.list AND w.key = i.list'
+                   " AND (r.status IS NULL OR (r.status = 'R' AND"
+                   ' (s.manager OR r.owner = :user)))'
+                   ' ORDER BY f.rank LIMIT :limit OFFSET :offset' % (
+            self._search_scope(),), {
+            'match': match, 'user': user.id, 'limit': limit,
+            'offset': offset, 'start': SNIPPET_START, 'end': SNIPPET_END,
+            'dots': u'\u2026'})
+
+        return [(Item(*r[:6]), Wishlist(*r[6:13]), r[13])
+                for r in cu.fetchall()]
+
     def reserveItem(self, user, item):
         """Let 'user' reserve 'item'."""
         cu = self.cx.cursor ()
@@ -789,6 +1313,48 @@ Votre webmaster@mes-souhaits.net
         self.cx.commit ()
         return True
 
+    def reservationHolder(self, item):
+        """Return the key of the user who reserved 'item', or None."""
+        cu = self.cx.cursor()
+        cu.execute('SELECT owner FROM reservation WHERE item = ?', (item.key,))
+        row = cu.fetchone()
+        return row and row[0]
+
+    def reservationHolders(self, lst):
+        """Return {item key: user key} for the reserved items of list 'lst'.
+
+        Args:
+          lst: the key of the list
+        """
+        cu = self.cx.cursor()
+        cu.execute('SELECT r.item, r.owner FROM item i, reservation r'
+                   ' WHERE i.list = ? AND r.item = i.key', (lst,))
+        return dict(cu.fetchall())
+
+    def persistReservations(self, claims):
+        """Write reservations in a single transaction.
+
+        Args:
+          claims: list of (item key, user key)
+
+        Returns:
+          set of the item keys that were reserved already or are gone
+        """
+        # Not INSERT OR IGNORE: the conflict clause would apply to the
+        # triggers as well, and keep them from bumping the list version.
+        cu = self.cx.cursor()
+        lost = set()
+        for key, user in claims:
+            cu.execute("INSERT INTO reservation (item, owner, status)"
+                       " SELECT key, ?, 'R' FROM item WHERE key = ?"
+                       " AND NOT EXISTS (SELECT * FROM reservation"
+                       " WHERE item = ?)", (user, key, key))
+            if not cu.rowcount:
+                lost.add(key)
+
+        self.cx.commit()
+        return lost
+
     def isReserved (self, item):
         """Retuns whether 'item' is reserved."""
         cu = self.cx.cursor ()
@@ -801,6 +1367,7 @@ Votre webmaster@mes-souhaits.net
         
     def giveupItem(self, user, item):
         """Cancel the reservation on 'item' by 'user'."""
+        self.claims.flush()
         cu = self.cx.cursor ()
         cu.execute ("DELETE FROM reservation WHERE item = ?"
                     " AND owner = ? AND status = 'R'", (item.key, user.id))
@@ -812,6 +1379,7 @@ Votre webmaster@mes-souhaits.net
         if not user.email:
             return False
 
+        self.claims.flush()
         cu = self.cx.cursor()
         try:
             cu.execute("UPDATE reservation SET status = 'D',"
@@ -823,6 +1391,7 @@ Votre webmaster@mes-souhaits.net
             return False
 
         if not cu.rowcount:
+            self.cx.commit()
             log.msg('_not_ resending "donated" email')
             return True
 
@@ -872,6 +1441,70 @@ vos listes et réservations
   %(url)s
 """ % {'url': self.base_url + '/challenge/' + results[0]}
 
+    def listCounters(self, lst):
+        """Return the counters of a list.
+
+        Returns:
+          dict with the number of 'items', of open reservations
+          ('reserved'), of items 'donated' and of 'followers'
+        """
+        names = [name for name, _ in schema.COUNTERS]
+        cu = self.cx.cursor()
+        cu.execute('SELECT %s FROM wishlist WHERE key = ?' % ', '.join(names),
+                   (lst.id,))
+        row = cu.fetchone()
+        if row is None:
+            return dict.fromkeys(names, 0)
+        return dict(zip(names, row))
+
+    def repairCounters(self):
+        """Recompute the counters of the lists, and fix the wrong ones.
+
+        Returns:
+          int, the number of lists fixed
+        """
+        # The counters are computed once, by aggregating each table,
+        # rather than by a subquery per list (see schema.COUNTERS): only
+        # the wrong ones are then read again, by key.
+        names = [name for name, _ in schema.COUNTERS]
+        cu = self.cx.cursor()
+        cu.execute('CREATE TEMP TABLE counters (key INTEGER PRIMARY KEY, %s)'
+                   % ', '.join(names))
+        try:
+            cu.execute("""
+            INSERT INTO temp.counters (key, items, reserved, donated,
+                                       followers)
+            SELECT w.key, IFNULL(i.n, 0), IFNULL(r.reserved, 0),
+                   IFNULL(r.donated, 0), IFNULL(f.n, 0)
+            FROM wishlist w
+            LEFT JOIN (SELECT list, COUNT(*) AS n FROM item
+                       GROUP BY list) i ON i.list = w.key
+            LEFT JOIN (SELECT i.list AS list,
+                              SUM(r.status = 'R') AS reserved,
+                              SUM(r.status = 'D') AS donated
+                       FROM item i, reservation r WHERE r.item = i.key
+                       GROUP BY i.list) r ON r.list = w.key
+            LEFT JOIN (SELECT list, COUNT(*) AS n FROM friend
+                       GROUP BY list) f ON f.list = w.key
+            """)
+            cu.execute('UPDATE wishlist SET %s WHERE key IN'
+                       ' (SELECT c.key FROM temp.counters c, wishlist w'
+                       ' WHERE w.key = c.key AND (%s))' % (
+                ', '.join(['%s = (SELECT %s FROM temp.counters c'
+                           ' WHERE c.key = wishlist.key)' % (name, name)
+                           for name in names]),
+                ' OR '.join(['w.%s <> c.%s' % (name, name)
+                             for name in names])))
+            fixed = cu.rowcount
+            self.cx.commit()
+        finally:
+            cu.execute('DROP TABLE temp.counters')
+
+        if fixed:
+            log.msg('repaired the counters of %d lists' % fixed)
+            metrics.COUNTER_REPAIRS.inc(amount=fixed)
+        return fixed
+
     def getListReservations (self, lst):
         """Get all the reservation for the specified list."""
         cu = self.cx.cursor ()
@@ -886,6 +1519,14 @@ vos listes et réservations
             
         return res
 
+    def getUserReservationLists(self, user):
+        """Return the keys of the lists where 'user' reserved items."""
+        cu = self.cx.cursor()
+        cu.execute("SELECT DISTINCT i.list FROM reservation r, item i"
+                   " WHERE r.owner = ? AND r.status = 'R' AND i.key = r.item"
+                   " ORDER BY i.list", (user.id,))
+        return [r[0] for r in cu.fetchall()]
+
     def getUserReservations(self, user):
         """Get all the reservations made by 'user'."""
         cu = self.cx.cursor ()
@@ -936,6 +1577,37 @@ vos listes et réservations
                 'could not allocate item id. is the db full?')
         return rowid
 
+    def importItems(self, lst, items):
+        """Add several items at once, in a single transaction.
+
+        Args:
+          lst: Wishlist
+          items: list of (title, description, url, score)
+
+        Returns:
+          int, number of items added
+        """
+        if not items:
+            return 0
+
+        for _ in xrange(16):
+            keys = random.sample(xrange(1, 2**31), len(items))
+            try:
+                cu = self.cx.cursor ()
+                cu.executemany('INSERT INTO item (key, list, title,'
+                               ' description, url, score)'
+                               ' VALUES (?, ?, ?, ?, ?, ?)', [
+                    (key, lst.id) + tuple(item)
+                    for key, item in zip(keys, items)])
+                self.cx.commit()
+                return len(items)
+
+            except(sqlite.OperationalError, sqlite.IntegrityError):
+                self.cx.rollback()
+
+        raise sqlite.OperationalError(
+            'could not allocate item ids. is the db full?')
+
     def editItem(self, item, title, description, url, score):
         """Edit an item."""
         cu = self.cx.cursor ()
@@ -1002,6 +1674,7 @@ L'équipe de « Mes souhaits »
     
     def deleteItem(self, item, warn=True):
         """Delete one item."""
+        self.claims.flush()
         cu = self.cx.cursor ()
 
         # CAUTION: we need to warn the user before deleting the item,
@@ -1123,6 +1796,8 @@ par le site <http://mes-souhaits.net/>.
 
     def validate_challenge(self, challenge, session):
         """Check if a challenge is valid."""
+        # The reservations of the session user might be transferred
+        self.claims.flush()
         cu = self.cx.cursor ()
         cu.execute ('SELECT email, user FROM challenge WHERE challenge = ?', (
             challenge,))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Parse the items pasted in the bulk import form.
+
+Two formats are accepted:
+
+  - JSON: an array of objects with title, description, url and score
+    members;
+  - CSV: one item per line, in the order title, description, url,
+    score, with an optional header line.
+
+Missing fields are empty, and the score defaults to 2.
+"""
+
+import csv
+import json
+
+from cStringIO import StringIO
+
+# Maximum number of items imported at once
+MAX_ROWS = 1000
+
+# Maximum length of a field, in characters
+MAX_LENGTH = 10000
+
+FIELDS = ('title', 'description', 'url', 'score')
+
+# First cells identifying a CSV header
+_HEADERS = frozenset(('title', 'titre'))
+
+
+def _to_unicode(value):
+    """Decode a CSV cell, as the web forms are."""
+    if isinstance(value, unicode):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeError:
+        return value.decode('latin-1')
+
+
+def validate(fields):
+    """Check and clean up an item.
+
+    Args:
+      fields: dict with some of the FIELDS
+
+    Returns:
+      ((title, description, url, score), None) or (None, error message)
+    """
+    values = []
+    for name in FIELDS[:3]:
+        value = fields.get(name)
+        if value is None:
+            value = u''
+        if not isinstance(value, basestring):
+            return None, u'le champ %s doit être du texte' % name
+        value = _to_unicode(value).strip()
+        if len(value) > MAX_LENGTH:
+            return None, u'le champ %s est trop long' % name
+        values.append(value)
+
+    if not (values[0] or values[1] or values[2]):
+        return None, u'souhait vide'
+
+    score = fields.get('score')
+    if score is None or score == '':
+        score = 2
+    try:
+        score = int(score)
+    except (TypeError, ValueError):
+        return None, u'score invalide'
+    if score < 1 or score > 3:
+        return None, u'le score doit être entre 1 et 3'
+
+    return tuple(values) + (score,), None
+
+
+def _json_rows(text):
+    """Generate (number, fields or error) from a JSON array."""
+    try:
+        data = json.loads(text)
+    except ValueError, e:
+        yield 0, u'JSON invalide : %s' % e
+        return
+
+    if not isinstance(data, list):
+        yield 0, u'un tableau JSON est attendu'
+        return
+
+    for number, obj in enumerate(data):
+        if isinstance(obj, dict):
+            yield number + 1, obj
+        else:
+            yield number + 1, u'un objet JSON est attendu'
+
+
+def _csv_rows(text):
+    """Generate (number, fields or error) from CSV lines."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], ',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    try:
+        for number, cells in enumerate(csv.reader(StringIO(text), dialect)):
+            if not [c for c in cells if c.strip()]:
+                continue
+            if number == 0 and cells[0].strip().lower() in _HEADERS:
+                continue
+            yield number + 1, dict(zip(FIELDS, cells))
+    except csv.Error, e:
+        yield 0, u'CSV invalide : %s' % e
+
+
+def parse(text):
+    """Parse items in JSON or CSV.
+
+    Args:
+      text: str or unicode
+
+    Returns:
+      (list of (title, description, url, score),
+       list of (number of the item or line, error message))
+    """
+    if text.lstrip().startswith('['):
+        rows = _json_rows(text)
+    else:
+        rows = _csv_rows(text)
+
+    items, errors = [], []
+    for number, fields in rows:
+        if isinstance(fields, unicode):
+            errors.append((number, fields))
+            continue
+
+        item, error = validate(fields)
+        if error is not None:
+            errors.append((number, error))
+        elif len(items) >= MAX_ROWS:
+            errors.append((number, u'trop de souhaits (%d au plus)' %
+                           MAX_ROWS))
+            break
+        else:
+            items.append(item)
+
+    return items, errors
@@ -0,0 +1,242 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Scheduled upkeep of the database file.
+
+The garbage collector deletes rows, but the pages they used stay in
+the file, and the statistics of the query planner are never
+refreshed. Every PERIOD, during the hours of low traffic, the
+maintenance:
+
+  - runs ANALYZE the first time, and PRAGMA optimize after that, which
+    only analyzes again the tables that changed enough;
+  - converts the database to incremental auto-vacuum the first time,
+    with a VACUUM that rewrites the whole file;
+  - measures the file and its free pages, exported as metrics and
+    kept in the daily statistics;
+  - when the free pages are more than FREE_RATIO of the file, gives
+    them back with PRAGMA incremental_vacuum, a few at a time with a
+    pause between the steps, so that the requests are served in
+    between.
+
+The service runs on the connection of core.Service, in the reactor
+thread: each step is a short write transaction. The conversion is the
+exception: like the backups, it runs from a thread, on a connection of
+its own, so that the pages are still served while it lasts.
+"""
+
+import time
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+
+from souhaits import metrics, schema
+
+
+class Maintenance(service.Service):
+    """Periodic ANALYZE and incremental vacuum of the database.
+
+    Args:
+      srv: core.Service, whose connection is used
+      period: float, seconds between two checks
+      window: (int, int), first and last hour (local time, included)
+        of the low traffic
+      clock: IReactorTime, for the tests
+    """
+
+    PERIOD = 3600
+    WINDOW = (3, 5)
+
+    # Free pages given back per step, and pause between the steps
+    # (seconds)
+    PAGES_PER_STEP = 128
+    STEP_PAUSE = 0.05
+
+    # Share of free pages beyond which they are given back
+    FREE_RATIO = 0.1
+
+    def __init__(self, srv, period=PERIOD, window=WINDOW, clock=reactor):
+        self.srv = srv
+        self.period = period
+        self.window = window
+        self.clock = clock
+        self.task = None
+        self.pending = None
+        self.vacuum = None
+        self.converting = None
+
+    def startService(self):
+        """Start checking the database periodically."""
+        service.Service.startService(self)
+        self.task = task.LoopingCall(self.run)
+        self.task.clock = self.clock
+        self.task.start(self.period, now=False)
+
+    def stopService(self):
+        """Stop, interrupting the vacuum but waiting for the conversion."""
+        service.Service.stopService(self)
+        if self.task.running:
+            self.task.stop()
+        self._stop_vacuum()
+        return self.converting
+
+    def in_window(self):
+        """Return whether the traffic is expected to be low now."""
+        first, last = self.window
+        return first <= time.localtime(self.clock.seconds()).tm_hour <= last
+
+    def measure(self):
+        """Export the size of the file and the share of free pages.
+
+        Returns:
+          (total pages, free pages)
+        """
+        cu = self.srv.cx.cursor()
+        cu.execute('PRAGMA page_size')
+        page_size = cu.fetchone()[0]
+        cu.execute('PRAGMA page_count')
+        pages = cu.fetchone()[0]
+        cu.execute('PRAGMA freelist_count')
+        free = cu.fetchone()[0]
+
+        ratio = float(free) / pages if pages else 0.0
+        metrics.DB_BYTES.set(pages * page_size)
+        metrics.DB_FREE_RATIO.set(ratio)
+        self.srv.setStat('db_kbytes', pages * page_size // 1024)
+        self.srv.setStat('db_free_percent', int(round(100 * ratio)))
+        return pages, free
+
+    def analyze(self):
+        """Refresh the statistics of the query planner."""
+        start = time.time()
+        cu = self.srv.cx.cursor()
+        cu.execute("SELECT COUNT(*) FROM sqlite_master"
+                   " WHERE name = 'sqlite_stat1'")
+        if cu.fetchone()[0]:
+            name = 'optimize'
+            cu.execute('PRAGMA optimize')
+        else:
+            name = 'analyze'
+            cu.execute('ANALYZE')
+        self.srv.cx.commit()
+        metrics.MAINTENANCE_SECONDS.observe(time.time() - start, name)
+
+    def _convert(self):
+        """Convert the database on its own connection (runs in a thread)."""
+        cx = self.srv.connect()
+        try:
+            return schema.convert_auto_vacuum(cx)
+        finally:
+            cx.close()
+
+    def convert(self):
+        """Switch to incremental auto-vacuum, which a VACUUM applies.
+
+        Returns:
+          Deferred fired with whether the database was converted
+        """
+        start = time.time()
+
+        def _done(converted):
+            metrics.MAINTENANCE_SECONDS.observe(time.time() - start,
+                                                'convert')
+            self.measure()
+            return converted
+
+        def _failed(failure):
+            log.err(failure, 'conversion to incremental auto-vacuum failed')
+            return False
+
+        def _finally(result):
+            self.converting = None
+            return result
+
+        d = self.converting = threads.deferToThread(self._convert)
+        d.addCallbacks(_done, _failed).addBoth(_finally)
+        return d
+
+    def run(self, force=False):
+        """Check the database, unless the traffic may be high.
+
+        Args:
+          force: bool, if True run at any hour
+
+        Returns:
+          Deferred fired when the vacuum, if any, is over
+        """
+        if self.pending is not None:
+            return self.pending
+        if self.converting is not None:
+            return self.converting
+        if not (force or self.in_window()):
+            return defer.succeed(None)
+
+        self.analyze()
+
+        # The VACUUM of the conversion gives the free pages back too
+        cu = self.srv.cx.cursor()
+        cu.execute('PRAGMA auto_vacuum')
+        if cu.fetchone()[0] != schema.AUTO_VACUUM_INCREMENTAL:
+            return self.convert()
+
+        pages, free = self.measure()
+        log.msg('database: %d pages, %d free' % (pages, free))
+
+        if not pages or float(free) / pages <= self.FREE_RATIO:
+            return defer.succeed(None)
+
+        self.pending = defer.Deferred()
+        self.vacuum = task.LoopingCall(self._step, force)
+        self.vacuum.clock = self.clock
+        self.vacuum.start(self.STEP_PAUSE).addErrback(self._failed)
+        return self.pending
+
+    def _step(self, force):
+        """Give back a few free pages."""
+        start = time.time()
+        cu = self.srv.cx.cursor()
+        cu.execute('PRAGMA freelist_count')
+        before = cu.fetchone()[0]
+
+        # The pragma frees one page per row read
+        cu.execute('PRAGMA incremental_vacuum(%d)' % self.PAGES_PER_STEP)
+        cu.fetchall()
+        self.srv.cx.commit()
+
+        cu.execute('PRAGMA freelist_count')
+        after = cu.fetchone()[0]
+        metrics.VACUUMED_PAGES.inc(amount=before - after)
+        metrics.MAINTENANCE_SECONDS.observe(time.time() - start, 'vacuum')
+
+        if not after or not (force or self.in_window()):
+            self.measure()
+            self._stop_vacuum()
+
+    def _failed(self, failure):
+        """A step failed: stop until the next check."""
+        log.err(failure, 'incremental vacuum failed')
+        self._stop_vacuum()
+
+    def _stop_vacuum(self):
+        """Stop giving back pages, and fire 'pending'."""
+        if self.vacuum is not None and self.vacuum.running:
+            self.vacuum.stop()
+        self.vacuum = None
+
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.callback(None)
@@ -0,0 +1,237 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Process-wide metrics, exported in the Prometheus text format.
+
+Metrics are plain in-memory counters: the reactor is single-threaded,
+so there is no locking involved.
+"""
+
+# Latency buckets, in seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                5.0, 10.0)
+
+# Buckets for the number of SQL statements run by a single request
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace('\\', r'\\').replace('"', r'\"'). \
+           replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    """Format a set of labels as {a="x",b="y"}."""
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v)) for k, v in pairs])
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Metric(object):
+    """Base class for a family of samples sharing a name."""
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        """Return the sample key for a set of label values."""
+        if len(labels) != len(self.labels):
+            raise ValueError('%s expects labels %r' % (self.name, self.labels))
+        return tuple(labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) tuples."""
+        for key in sorted(self.values):
+            yield '', key, (), self.values[key]
+
+    def render(self):
+        """Return the metric in the text exposition format."""
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix, _format_labels(self.labels, key, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A monotonically increasing value."""
+    kind = 'counter'
+
+    def inc(self, *labels, **kw):
+        """Increment the counter (by 'amount', default 1)."""
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + kw.get('amount', 1)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        """Set the current value."""
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        _Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        """Record a single observation."""
+        key = self._key(labels)
+        try:
+            counts, total = self.values[key]
+        except KeyError:
+            counts, total = [0] * len(self.buckets), 0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = counts, total + value
+
+    def samples(self):
+        """Yield the buckets, the sum and the count of each series."""
+        for key in sorted(self.values):
+            counts, total = self.values[key]
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', key, [('le', _format_value(bound))], count
+            yield '_sum', key, (), total
+            yield '_count', key, (), counts[-1]
+
+
+class Registry(object):
+    """A collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all the metrics in the text exposition format."""
+        return '\n'.join([m.render() for m in self.metrics]) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'souhaits_requests_total', 'Pages rendered, by page class.',
+    ['page']))
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'souhaits_request_seconds', 'Time spent serving a page.',
+    ['page']))
+
+REQUEST_SQL_STATEMENTS = REGISTRY.register(Histogram(
+    'souhaits_request_sql_statements', 'SQL statements run per page.',
+    ['page'], COUNT_BUCKETS))
+
+REQUEST_SQL_SECONDS = REGISTRY.register(Histogram(
+    'souhaits_request_sql_seconds', 'Time spent in SQL per page.',
+    ['page']))
+
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'souhaits_cache_lookups_total', 'Cache lookups, by cache and outcome.',
+    ['cache', 'result']))
+
+GC_SECONDS = REGISTRY.register(Histogram(
+    'souhaits_gc_seconds', 'Duration of the garbage collector runs.'))
+
+GC_ROWS = REGISTRY.register(Counter(
+    'souhaits_gc_deleted_rows_total', 'Rows deleted by the garbage collector.',
+    ['table']))
+
+MAILS = REGISTRY.register(Counter(
+    'souhaits_mails_total', 'Outbound email messages.', ['transport']))
+
+BACKUP_SECONDS = REGISTRY.register(Histogram(
+    'souhaits_backup_seconds', 'Duration of the database backups.'))
+
+BACKUP_BYTES = REGISTRY.register(Gauge(
+    'souhaits_backup_bytes', 'Size of the last database backup.'))
+
+BACKUP_FAILURES = REGISTRY.register(Counter(
+    'souhaits_backup_failures_total', 'Database backups that failed.'))
+
+RESERVATIONS = REGISTRY.register(Counter(
+    'souhaits_reservations_total', 'Reservation requests, by outcome.',
+    ['result']))
+
+RESERVATION_BATCH = REGISTRY.register(Histogram(
+    'souhaits_reservation_batch', 'Reservations written per transaction.',
+    (), COUNT_BUCKETS))
+
+SHED = REGISTRY.register(Counter(
+    'souhaits_shed_requests_total', 'Requests turned away, by reason.',
+    ['reason']))
+
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'souhaits_requests_in_flight', 'Page requests being served.'))
+
+REACTOR_LAG = REGISTRY.register(Gauge(
+    'souhaits_reactor_lag_seconds', 'How late the reactor last ran.'))
+
+COUNTER_REPAIRS = REGISTRY.register(Counter(
+    'souhaits_counter_repairs_total',
+    'Lists whose counters had to be recomputed.'))
+
+DB_BYTES = REGISTRY.register(Gauge(
+    'souhaits_db_bytes', 'Size of the database file, as last measured.'))
+
+DB_FREE_RATIO = REGISTRY.register(Gauge(
+    'souhaits_db_free_ratio', 'Share of free pages in the database file.'))
+
+MAINTENANCE_SECONDS = REGISTRY.register(Histogram(
+    'souhaits_maintenance_seconds', 'Duration of the database upkeep,'
+    ' by task.', ['task']))
+
+VACUUMED_PAGES = REGISTRY.register(Counter(
+    'souhaits_vacuumed_pages_total', 'Free pages given back to the system.'))
+
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    'souhaits_startup_seconds', 'Duration of the phases of the start.',
+    ['phase']))
+
+
+def cache_lookup(cache, hit):
+    """Record a hit or a miss for the cache named 'cache'."""
+    if hit:
+        CACHE_LOOKUPS.inc(cache, 'hit')
+    else:
+        CACHE_LOOKUPS.inc(cache, 'miss')
@@ -20,7 +20,7 @@
 (it's going to be split into submodules in souhaits.web)
 """
 
-from nevow import loaders, inevow
+from nevow import inevow
 from nevow.inevow import IRequest
 
 from twisted.web import static
@@ -28,20 +28,27 @@ from twisted.python import log
 
 from nevow import tags as T, url
 
-from souhaits import session, TEMPLATE_DIR, STATIC_DIR, core, format
+from souhaits import session, STATIC_DIR, core, format
+from souhaits import importer
 from souhaits.core import IService
 
-from souhaits.web import arg
+from souhaits.web import arg, format_cursor, parse_cursor, template
+from souhaits.web.site import next_turn
+from souhaits.web import admin
+from souhaits.web import api
+from souhaits.web import export
+from souhaits.web import search
 from souhaits.web import theme
 from souhaits.web.list import NewList, NewListFragment
 from souhaits.web.invite import Invite
 from souhaits.web import login
+from souhaits.web import monitoring
 from souhaits.web import widget
 
 from souhaits.web.base import BasePage
 from souhaits.web.errors import The404Page, The500Page
 
-from souhaits.session import must_user, maybe_user, message
+from souhaits.session import is_guest, must_user, maybe_user, message
 
 import os, re
 
@@ -202,14 +209,14 @@ class ListDestroy(BasePage, widget.RoundedBoxMixin):
 
         t = ctx.tag
         
-        r = len(srv.getListReservations(self.list))  # pylint: disable-msg=E1101
+        # pylint: disable-msg=E1101
+        r = srv.listCounters(self.list)['reserved']
         if r:
             if r == 1:
                 txt = 'une réservation'
             else:
                 txt = '%d réservations' % r
 
-            # pylint: disable-msg=E1101
             t = t[u'Il y a ', T.b[txt], u' sur cette liste.']
 
         return t
@@ -232,6 +239,58 @@ class ListDestroy(BasePage, widget.RoundedBoxMixin):
         return url.URL.fromString ("/")
     
 
+class ListImport(BasePage, widget.RoundedBoxMixin):
+    """Serve /some_list/import."""
+    contentTemplateFile = 'listimport.xml'
+
+    # Number of errors reported in detail
+    MAX_ERRORS = 10
+
+    def __init__ (self, lst):
+        widget.RoundedBoxMixin.__init__(self)
+        BasePage.__init__(self, lst.name or 'Liste sans nom')
+        self.list = lst
+
+    def render_list_title(self, ctx, _):
+        """Render the list title."""
+        return ctx.tag[self.list.name or u'Liste sans titre']
+
+    def child_confirm(self, ctx):
+        """Import the items."""
+        avatar = must_user(ctx)
+        back = url.URL.fromContext(ctx).up()
+
+        if not manages_list(ctx, avatar, self.list):
+            log.msg('unauthorized access to the list/import method')
+            return back
+
+        if ctx.arg('cancel'):
+            message(ctx, u"L'opération a été annulée.")
+            return back
+
+        text = ctx.arg('file') or ctx.arg('data') or ''
+        items, errors = importer.parse(text)
+
+        # pylint: disable-msg=E1101
+        count = IService(ctx).importItems(self.list, items)
+
+        if count == 1:
+            message(ctx, u'Un souhait a été importé.')
+        elif count:
+            message(ctx, u'%d souhaits ont été importés.' % count)
+
+        for number, error in errors[:self.MAX_ERRORS]:
+            message(ctx, u'Souhait n°%d ignoré\xa0: %s' % (number, error))
+        if len(errors) > self.MAX_ERRORS:
+            message(ctx, u'... et %d autres erreurs.' % (
+                len(errors) - self.MAX_ERRORS))
+
+        if not count and not errors:
+            message(ctx, u"Aucun souhait n'a été trouvé.")
+
+        return back
+
+
 class ListDescription(BasePage, widget.RoundedBoxMixin):
     """ Edit the parameters of a list """
 
@@ -408,14 +467,7 @@ class ListBase(BasePage):
 
     def _make_score(self, score):
         """Generate the stars corresponding to a score of 'score'."""
-        score_code = []
-        for value in (1, 2, 3):
-            # pylint: disable-msg=E1101
-            if value > score:
-                score_code.append(T.img(src="/images/star-off.png"))
-            else:
-                score_code.append(T.img(src="/images/star-on.png"))
-        return score_code
+        return widget.stars(score)
 
     def render_fullList(self, ctx, data):
         """Render all the info for a list entry."""
@@ -519,7 +571,7 @@ class ListItem(ListBase, widget.RoundedBoxMixin):
 
     def render_maybeEdit(self, ctx, _):
         """Render the edit buttons if the item can be edited."""
-        if manages_list(ctx, must_user(ctx), self.list):
+        if manages_list(ctx, maybe_user(ctx), self.list):
 
             # pylint: disable-msg=E1101
             def _make_option(value, comment):
@@ -608,9 +660,28 @@ class ListItem(ListBase, widget.RoundedBoxMixin):
         if not avatar.anonymous:
             srv = IService(ctx)
             # pylint: disable-msg=E1101
-            srv.reserveItem(avatar.user, self.item)
-            message(ctx, u'Votre réservation est enregistrée.')
-            return url.URL.fromContext(ctx).up()
+            back = url.URL.fromContext(ctx).up()
+            if not srv.claims.reserve(avatar.user, self.item):
+                message(ctx, u"Ce souhait vient d'être réservé par"
+                        u" quelqu'un d'autre.")
+                return back
+
+            # The user is only told once the reservation is written
+            def _written(done):
+                if done:
+                    message(ctx, u'Votre réservation est enregistrée.')
+                else:
+                    message(ctx, u"Ce souhait vient d'être réservé par"
+                            u" quelqu'un d'autre.")
+                return back
+
+            def _failed(_):
+                message(ctx, u"Votre réservation n'a pas pu être"
+                        u" enregistrée, veuillez réessayer.")
+                return back
+
+            return srv.claims.written(self.item).addCallbacks(
+                _written, _failed)
         
         message(ctx, u'Votre réservation sera effective lorsque '
                 u'vous vous serez identifié.')
@@ -674,7 +745,7 @@ class DelItem(ListBase):
     def render_maybeEdit(self, ctx, _):
         """Render action buttons if available."""
         # pylint: disable-msg=E1101
-        if manages_list(ctx, must_user(ctx), self.list):
+        if manages_list(ctx, maybe_user(ctx), self.list):
             srv = IService(ctx)
             if srv.isReserved(self.item):
                 notify = T.p[
@@ -724,10 +795,66 @@ class List(ListBase):
 
     contentTemplateFile = 'list.xml'
 
+    # Number of items shown at once
+    ITEMS_PER_PAGE = 500
+
+    # The items are read and written by chunks of that many
+    ITEMS_PER_CHUNK = 50
+
     def __init__(self, lst):
         ListBase.__init__(self, lst.name or 'Liste sans nom')
 
         self.list = lst
+        self.next_page = None
+        self.snapshot = None
+
+    def renderHTTP(self, ctx):
+        """Render the list, or serve guests the snapshot they share.
+
+        Guests all see the same page, so it is rendered once per
+        version of the list. Nothing is written to the database.
+        """
+        request = IRequest(ctx)
+        if request.method != 'GET' or request.args or not is_guest(ctx):
+            return ListBase.renderHTTP(self, ctx)
+
+        # The links in the page are absolute
+        key = (self.list.id, str(url.URL.fromContext(ctx)))
+        html = IService(ctx).guest_pages.get(key)
+        if html is not None:
+            return html
+
+        # The version the page is rendered from: other lookups during
+        # the render may see a newer one.
+        version = IService(ctx).versions.get(self.list.id)
+        self.snapshot = key, version, []
+        request.notifyFinish().addErrback(self._drop_snapshot)
+        return ListBase.renderHTTP(self, ctx)
+
+    def _drop_snapshot(self, _):
+        """The client is gone: the snapshot might be incomplete."""
+        self.snapshot = None
+
+    def flattenFactory(self, doc, ctx, writer, finisher):
+        """Keep a copy of the page for the guests, if it is one."""
+        if self.snapshot is None:
+            return ListBase.flattenFactory(self, doc, ctx, writer, finisher)
+
+        def _write(data):
+            """Write 'data', and keep it."""
+            if self.snapshot is not None:
+                self.snapshot[2].append(data)
+            writer(data)
+
+        def _finish(result):
+            """Store the complete snapshot."""
+            if self.snapshot is not None:
+                key, version, chunks = self.snapshot
+                IService(ctx).guest_pages.put(key, self.list.id,
+                                              ''.join(chunks), version)
+            return finisher(result)
+
+        return ListBase.flattenFactory(self, doc, ctx, _write, _finish)
 
     def beforeRender(self, ctx):
         """Called before the page is actually rendered."""
@@ -769,6 +896,8 @@ class List(ListBase):
                 ' :: ',
                 T.a(href=url.here.child('edit'))[u'Modifier'],
                 ' :: ',
+                T.a(href=url.here.child('import'))[u'Importer'],
+                ' :: ',
                 T.a(href=url.here.child('destroy'))[u'Détruire'],
                 ],
                     T.div(_class="listaction")[
@@ -783,36 +912,67 @@ class List(ListBase):
         return ctx.tag[desc]
 
 
-    def data_listContent(self, ctx, _):
-        """Return the list's content (ie the items)."""
+    def render_listContent(self, ctx, _):
+        """Render the list's content (ie the items).
+
+        The items are read and flattened by chunks, each one on its
+        own turn of the reactor. Nevow writes out what is flattened
+        before each Deferred, so the top of the page and then every
+        chunk are sent as soon as they are ready.
+        """
         avatar = maybe_user(ctx)
-        editable = manages_list(ctx, avatar, self.list)
+        srv = IService(ctx)
 
-        needs_reservation = not editable or self.list.showres
+        if avatar.anonymous:
+            user = None
+        else:
+            user = avatar.user
 
-        srv = IService(ctx)
+        pattern = inevow.IQ(ctx).patternGenerator('item')
+        after = parse_cursor(ctx.arg('after'))
 
-        # pylint: disable-msg=E1101
-        items = srv.itemsForList(self.list, needs_reservation)
-
-        # The list admin needs to see all the items, for other users,
-        # discard items reserved by someone else
-        if not editable:
-            # Simple users have the "reserved" tag, but cannot see by
-            # whom
-            if avatar.anonymous:
-                user = None
-            else:
-                user = avatar.user.id
-                
-            items = [ item for item in items if
-                      item.res is None or item.res [0] == user ]
-
-            # discard the info about who reserved
-            for i in items:
-                if i.res:
-                    i.res = (i.res [0], i.res [1], None)
-        return items
+        request = IRequest(ctx)
+        gone = []
+        request.notifyFinish().addErrback(lambda _: gone.append(True))
+
+        def _chunks(after):
+            """Generate the items, chunk after chunk."""
+            left = self.ITEMS_PER_PAGE
+            while left > 0:
+                yield next_turn(request)
+                if gone:
+                    return
+
+                # pylint: disable-msg=E1101
+                items, self.next_page = srv.itemsForViewer(
+                    self.list, user, after, min(left, self.ITEMS_PER_CHUNK))
+
+                yield [pattern(data=item) for item in items]
+
+                left -= len(items)
+                after = self.next_page
+                if after is None:
+                    return
+
+        return ctx.tag.clear()[_chunks(after)]
+
+    def render_morePages(self, ctx, _):
+        """Render the links to the next and first pages of items."""
+        links = []
+        if ctx.arg('after'):
+            links.append(T.a(href=url.here.remove('after'))[
+                u'« Début de la liste'])
+
+        if self.next_page is not None:
+            if links:
+                links.append(' :: ')
+            links.append(T.a(href=url.here.replace(
+                'after', format_cursor(self.next_page)))[
+                u'Voir la suite »'])
+
+        if not links:
+            return ''
+        return ctx.tag[links]
 
     def render_possibleActions (self, ctx, data):
         """Render the buttons under am item."""
@@ -906,6 +1066,10 @@ class List(ListBase):
         """Handle the .../destroy page."""
         return ListDestroy(self.list)
 
+    def child_import(self, _):
+        """Handle the .../import page."""
+        return ListImport(self.list)
+
     def child_add(self, ctx):
         """Handle the .../add page."""
         avatar = must_user(ctx)
@@ -988,8 +1152,7 @@ class RootPage(ListBase, widget.RoundedBoxMixin):
         else:
             tmpl = 'welcome.xml'
         
-        return loaders.xmlfile (templateDir=TEMPLATE_DIR,
-                                template=tmpl)
+        return template(tmpl)
 
     def render_newUser(self, ctx, _):
         """Render the 'I'm a new user' fragment."""
@@ -1105,6 +1268,11 @@ class RootPage(ListBase, widget.RoundedBoxMixin):
     child_login  = Login()
     child_invite = Invite()
     child_about  = About()
+    child_metrics = monitoring.Metrics()
+    child_api    = api.Api()
+    child_export = export.Export()
+    child_search = search.Search()
+    child_admin  = admin.Admin()
     child_css    = static.File(os.path.join(STATIC_DIR, 'css'))
     child_images = static.File(os.path.join(STATIC_DIR, 'images'))
     child_js     = static.File(os.path.join(STATIC_DIR, 'js'))
@@ -0,0 +1,94 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Profile single requests in debug mode.
+
+A request is profiled when it has a 'profile' argument or an
+X-Souhaits-Profile header. The raw profile is saved in a
++profile-*.prof file (to be read with pstats), and a summary is
+written in the log along with the SQL statements executed.
+"""
+
+import cProfile
+import pstats
+import re
+import time
+
+from cStringIO import StringIO
+
+from twisted.python import log
+
+HEADER = 'x-souhaits-profile'
+
+# Number of functions listed in the log summary
+TOP_FUNCTIONS = 25
+
+
+def wants_profile(request):
+    """Return True if the request asks to be profiled."""
+    return bool(request.args.get('profile') or request.getHeader(HEADER))
+
+
+def profile_name(request):
+    """Return the name of the file holding the profile of 'request'."""
+    path = re.sub(r'[^a-zA-Z0-9]+', '_', request.path).strip('_') or 'root'
+    return '+profile-%s-%s-%s.prof' % (
+        time.strftime('%Y%m%d-%H%M%S'), request.method, path[:64])
+
+
+class RequestProfile(object):
+    """Profile of a single request, and the SQL statements it ran."""
+
+    def __init__(self, srv, request):
+        self.srv = srv
+        self.name = profile_name(request)
+        self.uri = request.uri
+        self.profiler = cProfile.Profile()
+        self.statements = []
+
+    def _record(self, sql, params, duration):
+        """Remember a SQL statement."""
+        self.statements.append((sql, params, duration))
+
+    def start(self):
+        """Start profiling."""
+        self.srv.cx.observers.append(self._record)
+        self.profiler.enable()
+
+    def stop(self, _=None):
+        """Stop profiling, save the profile and log a summary.
+
+        This is called when the request is finished, or when the client
+        is gone: the failure is not passed on, as it is no error.
+        """
+        self.profiler.disable()
+        self.srv.cx.observers.remove(self._record)
+
+        self.profiler.dump_stats(self.name)
+
+        out = StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+        out.write('%d SQL statements, %.1f ms:\n' % (
+            len(self.statements),
+            1000 * sum([s[2] for s in self.statements])))
+        for sql, params, duration in self.statements:
+            out.write('  %7.2f ms  %s  %r\n' % (
+                1000 * duration, ' '.join(sql.split()), params))
+
+        log.msg('profile of %s saved in %s\n%s' % (
+            self.uri, self.name, out.getvalue()))
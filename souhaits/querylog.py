@@ -0,0 +1,111 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Slow query log.
+
+Every statement run on the service's connection is timed. The slow
+ones are logged with their parameters, the Service method that ran
+them and their query plan, so that a missing index shows up in the
+logs.
+"""
+
+import sys
+
+from twisted.python import log
+
+# Only these statements can be explained
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def _normalize(sql):
+    """Collapse the whitespace of a statement."""
+    return ' '.join(sql.split())
+
+
+class QueryLog(object):
+    """Connection observer timing and summarizing the statements.
+
+    Members:
+      threshold: statements slower than this (in seconds) are logged
+      summary: dict mapping a statement to [count, total, max, slow]
+    """
+
+    def __init__(self, srv, threshold):
+        self.srv = srv
+        self.threshold = threshold
+        self.summary = {}
+        self.explainer = None
+
+    def __call__(self, sql, params, duration):
+        sql = _normalize(sql)
+
+        try:
+            entry = self.summary[sql]
+        except KeyError:
+            entry = self.summary[sql] = [0, 0.0, 0.0, 0]
+
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] = max(entry[2], duration)
+
+        if duration < self.threshold:
+            return
+
+        entry[3] += 1
+        log.msg('slow query (%.1f ms) in %s: %s %r\n%s' % (
+            1000 * duration, self.caller(), sql, params,
+            '\n'.join(self.explain(sql, params))))
+
+    def caller(self):
+        """Return the name of the Service method running a statement."""
+        frame = sys._getframe(1)  # pylint: disable-msg=W0212
+        while frame is not None:
+            if frame.f_locals.get('self') is self.srv:
+                return frame.f_code.co_name
+            frame = frame.f_back
+        return '?'
+
+    def explain(self, sql, params):
+        """Return the query plan of a statement, as a list of lines."""
+        if params is None or not sql.upper().startswith(_EXPLAINABLE):
+            return []
+
+        # The plan is computed on a separate connection: on the
+        # service's one, the EXPLAIN would commit the pending
+        # transaction.
+        if self.explainer is None:
+            self.explainer = self.srv.connect()
+
+        cu = self.explainer.cursor()
+        try:
+            cu.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ['  plan: ' + str(row[-1]) for row in cu.fetchall()]
+        except Exception, e:  # pylint: disable-msg=W0703
+            return ['  no plan: %s' % e]
+
+    def close(self):
+        """Close the connection used for the query plans."""
+        if self.explainer is not None:
+            self.explainer.close()
+            self.explainer = None
+
+    def report(self, count=20):
+        """Log the statements that took the most time overall."""
+        entries = sorted(self.summary.items(), key=lambda e: -e[1][1])
+        lines = ['%6d x %8.1f ms (max %6.1f ms, %d slow)  %s' % (
+            n, 1000 * total, 1000 * longest, slow, sql)
+                 for sql, (n, total, longest, slow) in entries[:count]]
+        log.msg('SQL summary, by total time:\n' + '\n'.join(lines))
@@ -0,0 +1,179 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Reservations under contention.
+
+When a list is shared with many people at once, the same items are
+asked for by several users within a few seconds. The claim table
+decides in memory who gets an item: the first one to ask. The others
+are turned down without a query, and the winners are written to the
+database together, in a single transaction, at the end of the current
+turn of the reactor.
+
+The table only knows about this process. An item not in the table is
+looked up in the database before it is claimed, and the insertion of
+the winners still relies on the uniqueness of the reservation of an
+item: a claim lost to another process in between is counted as a
+conflict. The holders of the items of a list are read at once, and
+remembered along with the version of the list. When the list changes,
+its own batches included, they are read again with a single query:
+the requests turned down never query the database one by one.
+
+The user is told about a reservation once it is written: written()
+fires after the batch. If the batch fails, its claims are forgotten,
+so that the next requests look the items up in the database again.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+
+from souhaits import metrics
+
+
+class Claims(object):
+    """Per-item claims of the reservations, decided in memory.
+
+    Args:
+      srv: core.Service
+      clock: IReactorTime, to schedule the writes
+    """
+
+    # Pending claims written at once, at most
+    MAX_BATCH = 200
+
+    # The holders remembered are forgotten past this number of lists
+    SIZE = 1000
+
+    def __init__(self, srv, clock=reactor):
+        self.srv = srv
+        self.clock = clock
+        # item key -> user key, for the claims not written yet
+        self.claims = {}
+        self.pending = []
+        # list key -> (list version, {item key: user key})
+        self.holders = {}
+        self.call = None
+        # item key -> Deferreds fired when the claim is written
+        self.waiting = {}
+
+    def _holders(self, lst):
+        """Return {item key: user key} for the reserved items of 'lst'."""
+        versions = self.srv.versions
+        versions.refresh()
+        version = versions.get(lst)
+
+        entry = self.holders.get(lst)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        # The version is read before the reservations, so that it is
+        # never newer than what is remembered.
+        if len(self.holders) >= self.SIZE:
+            self.holders.clear()
+        holders = self.srv.reservationHolders(lst)
+        self.holders[lst] = (version, holders)
+        return holders
+
+    def _holder(self, item):
+        """Return the key of the user holding 'item', or None."""
+        holder = self.claims.get(item.key)
+        if holder is not None:
+            return holder
+        return self._holders(item.list).get(item.key)
+
+    def reserve(self, user, item):
+        """Let 'user' reserve 'item'.
+
+        Returns:
+          True if 'user' holds the reservation, False if someone else does
+        """
+        holder = self._holder(item)
+        if holder is not None:
+            metrics.RESERVATIONS.inc(holder == user.id and 'held' or 'lost')
+            return holder == user.id
+
+        self.claims[item.key] = user.id
+        self.pending.append(item)
+        metrics.RESERVATIONS.inc('won')
+
+        if len(self.pending) >= self.MAX_BATCH:
+            self.flush()
+        elif self.call is None:
+            self.call = self.clock.callLater(0, self.flush)
+        return True
+
+    def written(self, item):
+        """Return a Deferred fired once the claim on 'item' is written.
+
+        It fires with True if the reservation is in the database, False
+        if it was lost to another process, and fails if the write
+        failed.
+        """
+        if item.key not in self.claims:
+            return defer.succeed(True)
+
+        d = defer.Deferred()
+        self.waiting.setdefault(item.key, []).append(d)
+        return d
+
+    def flush(self):
+        """Write the pending claims to the database.
+
+        The batch is shared by the requests that made the claims: it is
+        charged to none of them, whichever request runs it.
+        """
+        account, self.srv.account = self.srv.account, None
+        try:
+            self._flush()
+        finally:
+            self.srv.account = account
+
+    def _flush(self):
+        """Write the pending claims, whoever is charged."""
+        if self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        claims = [(item.key, self.claims[item.key]) for item in pending]
+        try:
+            lost = self.srv.persistReservations(claims)
+        except Exception:  # pylint: disable-msg=W0703
+            error = failure.Failure()
+            self.srv.cx.rollback()
+            log.err(error, 'cannot write %d reservations' % len(claims))
+            for key, _ in claims:
+                del self.claims[key]
+                metrics.RESERVATIONS.inc('failed')
+                for d in self.waiting.pop(key, ()):
+                    d.errback(error)
+            return
+        metrics.RESERVATION_BATCH.observe(len(claims))
+
+        # The writes changed the versions of the lists: their holders
+        # are read again, once per list, on the next request.
+        for key, user in claims:
+            del self.claims[key]
+            if key in lost:
+                metrics.RESERVATIONS.inc('conflict')
+                log.msg('item %d: reservation by user %d lost to another'
+                        ' process' % (key, user))
+            for d in self.waiting.pop(key, ()):
+                d.callback(key not in lost)
@@ -0,0 +1,511 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Database schema upgrades.
+
+The version of the schema is kept in PRAGMA user_version. Each
+function in MIGRATIONS brings the schema from version N to N+1; they
+are applied in order, each in its own transaction, when the service
+starts. A new database is created at version 0 and upgraded like the
+existing ones.
+"""
+
+from twisted.python import log
+
+# Value of PRAGMA auto_vacuum when the free pages are given back on
+# demand, with PRAGMA incremental_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Statement giving the next list version (see _list_version)
+NEXT_VERSION = '(SELECT IFNULL(MAX(version), 0) + 1 FROM list_version)'
+
+# Counter columns of wishlist, and how to compute them (see _counters)
+COUNTERS = [
+    ('items', '(SELECT COUNT(*) FROM item WHERE list = wishlist.key)'),
+    ('reserved', "(SELECT COUNT(*) FROM item i, reservation r"
+     " WHERE i.list = wishlist.key AND r.item = i.key AND r.status = 'R')"),
+    ('donated', "(SELECT COUNT(*) FROM item i, reservation r"
+     " WHERE i.list = wishlist.key AND r.item = i.key AND r.status = 'D')"),
+    ('followers', '(SELECT COUNT(*) FROM friend WHERE list = wishlist.key)'),
+    ]
+
+
+def _bump(list_expr):
+    """Return a statement bumping the version of list 'list_expr'."""
+    return ('INSERT OR REPLACE INTO list_version (list, version)'
+            ' SELECT %s, %s;' % (list_expr, NEXT_VERSION))
+
+
+def _list_version(cu):
+    """Per-list version, bumped whenever a list or its items change."""
+
+    # Versions come from a single counter shared by all the lists, so
+    # that a process can ask for everything that changed since the
+    # last version it has seen. Rows are never deleted: a version
+    # must not be handed out twice.
+    cu.execute("""
+    CREATE TABLE list_version (
+       list        INTEGER   PRIMARY KEY,
+       version     INTEGER   NOT NULL
+    )
+    """)
+    cu.execute('CREATE INDEX list_version_version ON list_version (version)')
+
+    cu.execute('INSERT INTO list_version (list, version)'
+               ' SELECT key, 1 FROM wishlist')
+
+    # The modification dates updated by the other triggers are not
+    # watched, so that a change only bumps the version once.
+    for name, event, bump in [
+        ('version_create_list', 'INSERT ON wishlist', _bump('new.key')),
+        ('version_update_list',
+         'UPDATE OF url, name, owner, description, showres, theme'
+         ' ON wishlist', _bump('new.key')),
+        ('version_delete_list', 'DELETE ON wishlist', _bump('old.key')),
+        ('version_create_item', 'INSERT ON item', _bump('new.list')),
+        ('version_update_item',
+         'UPDATE OF list, title, description, url, score ON item',
+         _bump('old.list') + _bump('new.list')),
+        ('version_delete_item', 'DELETE ON item', _bump('old.list')),
+        ('version_create_coeditor', 'INSERT ON coeditor', _bump('new.list')),
+        ('version_delete_coeditor', 'DELETE ON coeditor', _bump('old.list')),
+        ]:
+        cu.execute('CREATE TRIGGER %s AFTER %s BEGIN %s END;' % (
+            name, event, bump))
+
+    # A reservation is bound to its list through its item. When the
+    # item itself is deleted, its list has been bumped already.
+    for name, event, row in [
+        ('version_create_reservation', 'INSERT', 'new'),
+        ('version_update_reservation', 'UPDATE', 'new'),
+        ('version_delete_reservation', 'DELETE', 'old'),
+        ]:
+        cu.execute("""
+        CREATE TRIGGER %s AFTER %s ON reservation
+        BEGIN
+          INSERT OR REPLACE INTO list_version (list, version)
+            SELECT list, %s FROM item WHERE key = %s.item;
+        END;
+        """ % (name, event, NEXT_VERSION, row))
+
+
+def _list_event(cu):
+    """Append-only log of the changes made to the lists."""
+
+    # kind is one letter (see core.ListEvent); 'at' is a UNIX time.
+    # AUTOINCREMENT keeps the sequence numbers, which consumers use as
+    # cursors, from being reused once the GC trimmed the log.
+    cu.execute("""
+    CREATE TABLE list_event (
+       seq         INTEGER   PRIMARY KEY AUTOINCREMENT,
+       at          INTEGER   NOT NULL DEFAULT (strftime('%s', 'now')),
+       list        INTEGER   NOT NULL,
+       item        INTEGER,
+       kind        CHAR(1)   NOT NULL
+    )
+    """)
+    cu.execute('CREATE INDEX list_event_list ON list_event (list, seq)')
+
+    for name, event, when, values in [
+        ('event_create_item', 'INSERT ON item', '',
+         "new.list, new.key, 'c'"),
+        ('event_update_item',
+         'UPDATE OF list, title, description, url, score ON item', '',
+         "new.list, new.key, 'u'"),
+        ('event_delete_item', 'DELETE ON item', '',
+         "old.list, old.key, 'd'"),
+        ('event_update_list',
+         'UPDATE OF url, name, owner, description, showres, theme'
+         ' ON wishlist', '', "new.key, NULL, 'l'"),
+        ]:
+        cu.execute("""
+        CREATE TRIGGER %s AFTER %s %s
+        BEGIN
+          INSERT INTO list_event (list, item, kind) VALUES (%s);
+        END;
+        """ % (name, event, when, values))
+
+    # Reservations only know their item. A reservation deleted along
+    # with its item is not logged: the item is gone already.
+    for name, event, when, row, kind in [
+        ('event_reserve', 'INSERT', '', 'new', 'r'),
+        ('event_donate', 'UPDATE OF status',
+         "WHEN old.status = 'R' AND new.status = 'D'", 'new', 'D'),
+        ('event_giveup', 'DELETE', "WHEN old.status = 'R'", 'old', 'g'),
+        ]:
+        cu.execute("""
+        CREATE TRIGGER %s AFTER %s ON reservation %s
+        BEGIN
+          INSERT INTO list_event (list, item, kind)
+            SELECT list, key, '%s' FROM item WHERE key = %s.item;
+        END;
+        """ % (name, event, when, kind, row))
+
+
+def _friend_unread(cu):
+    """Number of changed items in the lists a user follows."""
+    cu.execute('ALTER TABLE friend ADD COLUMN unread INTEGER NOT NULL'
+               ' DEFAULT 0')
+
+    # The triggers update all the followers of a list
+    cu.execute('CREATE INDEX friend_list ON friend (list)')
+
+    # Until now, only the fact that the list changed was known
+    cu.execute("""
+    UPDATE friend SET unread = MAX(
+      (SELECT COUNT (*) FROM item i
+        WHERE i.list = friend.list AND i.modification > friend.visit),
+      (SELECT w.modification > friend.visit FROM wishlist w
+        WHERE w.key = friend.list))
+    """)
+
+    # A deleted item is not news. The counter is reset by a visit.
+    for name, event, row in [
+        ('unread_create_item', 'INSERT ON item', 'new'),
+        ('unread_update_item',
+         'UPDATE OF title, description, url, score ON item', 'new'),
+        ]:
+        cu.execute("""
+        CREATE TRIGGER %s AFTER %s
+        BEGIN
+          UPDATE friend SET unread = unread + 1 WHERE list = %s.list;
+        END;
+        """ % (name, event, row))
+
+
+def _item_order(cu):
+    """Index giving the items of a list in display order."""
+
+    # The key breaks the ties, so that (score, modification, key) is
+    # a cursor into the list. The index on (list) alone is redundant.
+    cu.execute('CREATE INDEX item_list_order ON item'
+               ' (list, score DESC, modification DESC, key DESC)')
+    cu.execute('DROP INDEX item_list')
+
+
+def _full_text(cu):
+    """Full-text index of the items and of the lists."""
+
+    # The indexes refer to the rows of item and wishlist instead of
+    # holding a copy of the text.
+    for table, key, columns in [
+        ('item', 'key', ('title', 'description')),
+        ('wishlist', 'key', ('name', 'description')),
+        ]:
+        fts = table + '_fts'
+        cu.execute("CREATE VIRTUAL TABLE %s USING fts5 (%s, content=%s,"
+                   " content_rowid=%s, tokenize='unicode61')" % (
+            fts, ', '.join(columns), table, key))
+
+        def values(row):
+            """Return the values indexed for 'row' (new or old)."""
+            return ', '.join(['%s.%s' % (row, c) for c in (key,) + columns])
+
+        insert = 'INSERT INTO %s (rowid, %s) VALUES (%s);' % (
+            fts, ', '.join(columns), values('new'))
+        delete = "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', %s);" % (
+            fts, fts, ', '.join(columns), values('old'))
+
+        for event, body in [
+            ('INSERT', insert),
+            ('UPDATE OF %s' % ', '.join(columns), delete + insert),
+            ('DELETE', delete),
+            ]:
+            cu.execute('CREATE TRIGGER %s_%s AFTER %s ON %s BEGIN %s END;' % (
+                fts, event.split()[0].lower(), event, table, body))
+
+        cu.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (fts, fts))
+
+
+def _user_version(cu):
+    """Per-user version, bumped when the lists in a user's sidebar change."""
+
+    # The lists themselves have their own versions: this one changes
+    # when lists are added to or removed from the sidebar, or when
+    # their number of unread items is reset by a visit.
+    cu.execute("""
+    CREATE TABLE user_version (
+       user        INTEGER   PRIMARY KEY,
+       version     INTEGER   NOT NULL
+    )
+    """)
+    cu.execute('CREATE INDEX user_version_version ON user_version (version)')
+
+    def bump(user_expr):
+        """Return a statement bumping the version of user 'user_expr'."""
+        return ('INSERT OR REPLACE INTO user_version (user, version)'
+                ' SELECT %s, (SELECT IFNULL(MAX(version), 0) + 1'
+                ' FROM user_version);' % user_expr)
+
+    for name, event, when, body in [
+        ('user_version_create_list', 'INSERT ON wishlist', '',
+         bump('new.owner')),
+        ('user_version_update_list', 'UPDATE OF owner ON wishlist', '',
+         bump('old.owner') + bump('new.owner')),
+        ('user_version_delete_list', 'DELETE ON wishlist', '',
+         bump('old.owner')),
+        ('user_version_follow', 'INSERT ON friend', '', bump('new.user')),
+        ('user_version_visit', 'UPDATE OF unread ON friend',
+         'WHEN new.unread < old.unread', bump('new.user')),
+        ('user_version_unfollow', 'DELETE ON friend', '', bump('old.user')),
+        ]:
+        cu.execute('CREATE TRIGGER %s AFTER %s %s BEGIN %s END;' % (
+            name, event, when, body))
+
+
+def _counters(cu):
+    """Counters of items, reservations and followers on the lists."""
+    for name, _ in COUNTERS:
+        cu.execute('ALTER TABLE wishlist ADD COLUMN %s INTEGER NOT NULL'
+                   ' DEFAULT 0' % name)
+    cu.execute('UPDATE wishlist SET %s' % ', '.join(
+        ['%s = %s' % counter for counter in COUNTERS]))
+
+    def count(lst, changes):
+        """Return a statement changing the counters of list 'lst'."""
+        return 'UPDATE wishlist SET %s WHERE key = %s;' % (', '.join(
+            ['%s = %s + (%s)' % (name, name, change)
+             for name, change in changes]), lst)
+
+    def status(row, sign):
+        """Return the changes of the counters for reservation 'row'."""
+        return [('reserved', "%s(%s.status = 'R')" % (sign, row)),
+                ('donated', "%s(%s.status = 'D')" % (sign, row))]
+
+    def reservations(item, sign):
+        """Return the changes of the counters for the reservation of 'item'."""
+        return [(name, "%s(SELECT COUNT(*) FROM reservation"
+                 " WHERE item = %s AND status = '%s')" % (sign, item, value))
+                for name, value in (('reserved', 'R'), ('donated', 'D'))]
+
+    # The reservations of a deleted item are deleted by delete_item:
+    # by then, the list of the item is not known anymore, so they are
+    # counted out with the item.
+    cu.execute('DROP TRIGGER delete_item')
+    cu.execute("""
+    CREATE TRIGGER delete_item AFTER DELETE ON item
+    BEGIN
+      UPDATE wishlist SET modification = CURRENT_TIMESTAMP WHERE old.list = key;
+      %s
+      DELETE from reservation WHERE item = old.key;
+    END;
+    """ % count('old.list', [('items', '-1')] +
+                reservations('old.key', '-')))
+
+    for name, event, body in [
+        ('count_create_item', 'INSERT ON item',
+         count('new.list', [('items', '1')])),
+        ('count_update_item', 'UPDATE OF list ON item',
+         count('old.list', [('items', '-1')] + reservations('new.key', '-')) +
+         count('new.list', [('items', '1')] + reservations('new.key', ''))),
+        ('count_follow', 'INSERT ON friend',
+         count('new.list', [('followers', '1')])),
+        ('count_update_friend', 'UPDATE OF list ON friend',
+         count('old.list', [('followers', '-1')]) +
+         count('new.list', [('followers', '1')])),
+        ('count_unfollow', 'DELETE ON friend',
+         count('old.list', [('followers', '-1')])),
+        ('count_create_reservation', 'INSERT ON reservation',
+         count('(SELECT list FROM item WHERE key = new.item)',
+               status('new', ''))),
+        ('count_update_reservation', 'UPDATE OF item, status ON reservation',
+         count('(SELECT list FROM item WHERE key = old.item)',
+               status('old', '-')) +
+         count('(SELECT list FROM item WHERE key = new.item)',
+               status('new', ''))),
+        ('count_delete_reservation', 'DELETE ON reservation',
+         count('(SELECT list FROM item WHERE key = old.item)',
+               status('old', '-'))),
+        ]:
+        cu.execute('CREATE TRIGGER %s AFTER %s BEGIN %s END;' % (
+            name, event, body))
+
+
+def count_stat(name, amount='1', day="date('now')"):
+    """Return the statements adding 'amount' to statistic 'name' of 'day'."""
+    return ("INSERT OR IGNORE INTO daily_stats (day, name, value)"
+            " VALUES (%s, '%s', 0);"
+            " UPDATE daily_stats SET value = value + (%s)"
+            " WHERE day = %s AND name = '%s';" % (
+                day, name, amount, day, name))
+
+
+def _daily_stats(cu):
+    """Statistics of the site, aggregated by day as things happen."""
+
+    # 'day' is an ISO date (UTC), or '' for the running totals. The
+    # primary key gives the rows of the last days in a range scan.
+    cu.execute("""
+    CREATE TABLE daily_stats (
+       day         TEXT      NOT NULL,
+       name        TEXT      NOT NULL,
+       value       INTEGER   NOT NULL,
+       PRIMARY KEY (day, name)
+    )
+    """)
+
+    cu.execute("INSERT INTO daily_stats (day, name, value)"
+               " SELECT '', 'challenges_pending', COUNT(*) FROM challenge"
+               " WHERE NOT active")
+
+    # A session is active on a day when it is used on that day; the
+    # activity of a session is updated at each request.
+    for name, event, when, body in [
+        ('stats_create_user', 'INSERT ON user', '',
+         count_stat('users_created')),
+        ('stats_identify_user', 'UPDATE OF email ON user',
+         'WHEN old.email IS NULL AND new.email IS NOT NULL',
+         count_stat('users_identified')),
+        ('stats_create_session', 'INSERT ON session', '',
+         count_stat('sessions_active')),
+        ('stats_session_activity', 'UPDATE OF activity ON session',
+         'WHEN date(old.activity) < date(new.activity)',
+         count_stat('sessions_active')),
+        ('stats_create_list', 'INSERT ON wishlist', '',
+         count_stat('lists_created')),
+        ('stats_create_item', 'INSERT ON item', '',
+         count_stat('items_created')),
+        ('stats_reserve', 'INSERT ON reservation', '',
+         count_stat('reservations')),
+        ('stats_donate', 'UPDATE OF status ON reservation',
+         "WHEN old.status <> 'D' AND new.status = 'D'",
+         count_stat('donations')),
+        ('stats_create_challenge', 'INSERT ON challenge', '',
+         count_stat('challenges') +
+         count_stat('challenges_pending', 'NOT new.active', "''")),
+        ('stats_activate_challenge', 'UPDATE OF active ON challenge',
+         'WHEN NOT old.active AND new.active',
+         count_stat('challenges_pending', '-1', "''")),
+        ('stats_delete_challenge', 'DELETE ON challenge',
+         'WHEN NOT old.active',
+         count_stat('challenges_pending', '-1', "''")),
+        ]:
+        cu.execute('CREATE TRIGGER %s AFTER %s %s BEGIN %s END;' % (
+            name, event, when, body))
+
+
+def _incremental_vacuum(cu):
+    """Free pages given back on demand (auto_vacuum = INCREMENTAL)."""
+
+    # The mode of an existing database only changes with a VACUUM,
+    # which rewrites the whole file: the maintenance runs it later, in
+    # the hours of low traffic (see convert_auto_vacuum).
+    cu.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+
+def _challenge_stats(cu):
+    """Challenges without 'active' counted as pending, like inactive ones."""
+
+    # 'active' is NULL when a challenge is inserted without it: the
+    # triggers of _daily_stats added NULL to the total, which failed,
+    # and the initial count skipped such challenges.
+    cu.execute("DELETE FROM daily_stats"
+               " WHERE day = '' AND name = 'challenges_pending'")
+    cu.execute("INSERT INTO daily_stats (day, name, value)"
+               " SELECT '', 'challenges_pending', COUNT(*) FROM challenge"
+               " WHERE IFNULL(active, 0) = 0")
+
+    for name, event, when, body in [
+        ('stats_create_challenge', 'INSERT ON challenge', '',
+         count_stat('challenges') +
+         count_stat('challenges_pending', 'IFNULL(new.active, 0) = 0',
+                    "''")),
+        ('stats_activate_challenge', 'UPDATE OF active ON challenge',
+         'WHEN IFNULL(old.active, 0) = 0 AND IFNULL(new.active, 0) <> 0',
+         count_stat('challenges_pending', '-1', "''")),
+        ('stats_delete_challenge', 'DELETE ON challenge',
+         'WHEN IFNULL(old.active, 0) = 0',
+         count_stat('challenges_pending', '-1', "''")),
+        ]:
+        cu.execute('DROP TRIGGER %s' % name)
+        cu.execute('CREATE TRIGGER %s AFTER %s %s BEGIN %s END;' % (
+            name, event, when, body))
+
+
+MIGRATIONS = [
+    _list_version,
+    _list_event,
+    _friend_unread,
+    _item_order,
+    _full_text,
+    _user_version,
+    _counters,
+    _daily_stats,
+    _incremental_vacuum,
+    _challenge_stats,
+    ]
+
+
+def upgrade(cx):
+    """Apply the missing migrations to the database behind 'cx'."""
+    cu = cx.cursor()
+    cu.execute('PRAGMA user_version')
+    if cu.fetchone()[0] < len(MIGRATIONS):
+        _migrate(cx, cu)
+
+
+def _migrate(cx, cu):
+    """Apply the missing migrations in a single transaction."""
+    # Schema changes are only transactional when the transaction is
+    # handled explicitly. BEGIN IMMEDIATE also keeps the other
+    # processes from upgrading the database at the same time.
+    isolation_level = cx.isolation_level
+    cx.isolation_level = None
+    try:
+        cu.execute('BEGIN IMMEDIATE')
+        try:
+            cu.execute('PRAGMA user_version')
+            version = cu.fetchone()[0]
+
+            for number, migration in enumerate(MIGRATIONS[version:],
+                                               version + 1):
+                log.msg('upgrading the database to version %d: %s' % (
+                    number, migration.__doc__))
+                migration(cu)
+                cu.execute('PRAGMA user_version = %d' % number)
+        except:
+            cu.execute('ROLLBACK')
+            raise
+        cu.execute('COMMIT')
+    finally:
+        cx.isolation_level = isolation_level
+
+
+def convert_auto_vacuum(cx):
+    """Rewrite the database behind 'cx' in incremental auto-vacuum mode.
+
+    The VACUUM rewrites the whole file, so the maintenance runs it once,
+    in the hours of low traffic, from a thread on a connection of its
+    own. If another process holds the database, the conversion is left
+    to the next run.
+
+    Returns:
+      bool, whether the database was converted
+    """
+    log.msg('converting the database to incremental auto-vacuum')
+    cu = cx.cursor()
+    isolation_level = cx.isolation_level
+    cx.isolation_level = None
+    try:
+        cu.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cu.execute('VACUUM')
+    except cx.OperationalError:
+        log.err(None, 'cannot convert the database to incremental'
+                ' auto-vacuum')
+        return False
+    finally:
+        cx.isolation_level = isolation_level
+    return True
@@ -22,6 +22,7 @@ from nevow.inevow import ISession, IRequest
 from twisted.python import log
 
 from souhaits.core import IService
+from souhaits.web.site import add_time
 
 COOKIE_KEY  = 'Session_Souhaits'
 COOKIE_LIFE = 3600 * 24 * 180  # 180 days of expiry time
@@ -87,6 +88,7 @@ def session_cookie(ctx):
 
 def maybe_user(ctx):
     """Return the user's avatar, but don't create a session."""
+    start = time.time()
     cookie = session_cookie(ctx)
     srv = IService(ctx)
     # pylint: disable-msg=E1101
@@ -94,9 +96,27 @@ def maybe_user(ctx):
     if user.session:
         # extend the cookie
         _set_cookie(ctx, user.session)
+    add_time(IRequest(ctx), 'session', time.time() - start)
     return user
 
 
+def is_guest(ctx):
+    """Return whether nothing is known about the visitor.
+
+    A guest has neither a session of ours nor a Nevow session (which
+    holds the pending messages): all the guests see the same pages.
+    Telling one costs no write.
+    """
+    request = IRequest(ctx)
+    for name in request.received_cookies:
+        if name.startswith('TWISTED_'):
+            return False
+
+    if session_cookie(ctx) is None:
+        return True
+    return maybe_user(ctx).user is None
+
+
 def must_user(ctx):
     """Ensure that the user has a session and return its avatar."""
     user = maybe_user(ctx)
@@ -105,8 +125,11 @@ def must_user(ctx):
     if user.user:
         return user
 
+    start = time.time()
     user, cookie = _create_session(ctx)
-    return Avatar(user, srv, cookie)
+    user = Avatar(user, srv, cookie)
+    add_time(IRequest(ctx), 'session', time.time() - start)
+    return user
 
 
 def destroy_session(ctx):
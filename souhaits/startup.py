@@ -0,0 +1,94 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Measured start of a process.
+
+The start is cut in phases, from the import of the package to the
+moment the process is ready to accept connections. Each phase is
+timed, exported as a metric and logged in a report at the end of the
+warm-up.
+
+The warm-up service is started after the database and before the
+port: it checks that the templates parse, prepares the common
+statements and fills the caches, so that the first requests after a
+restart are served as fast as the next ones.
+"""
+
+import time
+
+from twisted.application import service
+from twisted.python import log
+
+import souhaits
+from souhaits import metrics, web
+
+
+class Phases(object):
+    """Durations of the phases of the start, in order.
+
+    Args:
+      start: float, time at which the first phase started
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.durations = []
+        self.ready = False
+
+    def mark(self, name):
+        """Note that phase 'name' ends now (ignored once ready)."""
+        if self.ready:
+            return
+
+        now = time.time()
+        self.durations.append((name, now - self.last))
+        metrics.STARTUP_SECONDS.set(now - self.last, name)
+        self.last = now
+
+    def report(self):
+        """Log the duration of each phase; the next marks are ignored."""
+        self.ready = True
+        log.msg('startup: %s; ready in %.3f s' % (
+            ', '.join(['%s %.3f s' % d for d in self.durations]),
+            self.last - self.start))
+
+
+# The phases of this process
+PHASES = Phases(souhaits.STARTED)
+
+
+class WarmUp(service.Service):
+    """Prepare the process for its first requests.
+
+    Args:
+      srv: core.Service, already started
+    """
+
+    def __init__(self, srv):
+        self.srv = srv
+
+    def startService(self):
+        """Warm up, and report the startup phases."""
+        service.Service.startService(self)
+
+        web.load_templates()
+        PHASES.mark('templates')
+
+        self.srv.warmUp()
+        PHASES.mark('warm-up')
+
+        PHASES.report()
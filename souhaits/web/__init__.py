@@ -1,5 +1,38 @@
 """Implementation of the webpages."""
 
+import os
+
+from nevow import loaders
+
+from souhaits import TEMPLATE_DIR
+
+# Loaders of the templates, by file name
+_TEMPLATES = {}
+
+
+def template(name):
+    """Return the loader of template 'name', shared by all the pages.
+
+    Depending on the version of nevow, the parsed documents are cached
+    by each loader rather than by file: the pages must not create their
+    own at each render.
+    """
+    try:
+        return _TEMPLATES[name]
+    except KeyError:
+        pass
+
+    loader = _TEMPLATES[name] = loaders.xmlfile(templateDir=TEMPLATE_DIR,
+                                                template=name)
+    return loader
+
+
+def load_templates():
+    """Parse all the templates, so that a broken one stops the start."""
+    for name in sorted(os.listdir(TEMPLATE_DIR)):
+        if name.endswith('.xml'):
+            template(name).load()
+
 def arg(req, name, default=''):
     """Extract a single argument from a request, as a unicode string."""
     value = req.args.get(name, [default])[0].strip()
@@ -9,4 +42,24 @@ def arg(req, name, default=''):
         except UnicodeError:
             value = value.decode('latin-1')
     return value
-    
+
+
+def format_cursor(cursor):
+    """Encode a cursor returned by itemsForListPage for an URL."""
+    score, modification, key = cursor
+    if score is None:
+        score = ''
+    return '%s,%s,%d' % (score, modification, key)
+
+
+def parse_cursor(text):
+    """Decode a cursor encoded by format_cursor, or return None."""
+    try:
+        score, modification, key = text.split(',')
+        if score:
+            score = int(score)
+        else:
+            score = None
+        return score, modification, int(key)
+    except (AttributeError, ValueError):
+        return None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Pages reserved to the administrator of the site: /admin/..."""
+
+from nevow import rend, tags as T, url
+
+from souhaits.core import IService
+from souhaits.session import maybe_user
+from souhaits.web.base import BasePage
+
+# Columns of the statistics table: (name of the statistic, title)
+COLUMNS = [
+    ('sessions_active', u'Sessions actives'),
+    ('users_created', u'Nouveaux utilisateurs'),
+    ('users_identified', u'Utilisateurs identifiés'),
+    ('lists_created', u'Listes créées'),
+    ('items_created', u'Souhaits créés'),
+    ('reservations', u'Réservations'),
+    ('donations', u'Cadeaux donnés'),
+    ('challenges', u'Défis envoyés'),
+    ('mails', u'Mails'),
+    ('db_kbytes', u'Base (ko)'),
+    ('db_free_percent', u'Pages libres (%)'),
+    ]
+
+
+def is_admin(ctx):
+    """Return whether the connected user is the administrator."""
+    avatar = maybe_user(ctx)
+    # pylint: disable-msg=E1101
+    return bool(avatar.identified and
+                avatar.user.email == IService(ctx).ADMIN)
+
+
+class Stats(BasePage):
+    """Serves /admin/stats."""
+    contentTemplateFile = 'stats.xml'
+
+    # Number of days shown
+    DAYS = 30
+
+    def __init__(self):
+        BasePage.__init__(self, u'Statistiques')
+
+    def render_stats(self, ctx, _):
+        """Render the daily statistics and the totals."""
+        # pylint: disable-msg=E1101
+        by_day, totals = IService(ctx).dailyStats(self.DAYS)
+
+        rows = [T.tr[T.th[u'Jour'], [T.th[title] for _, title in COLUMNS]]]
+        for day, stats in by_day:
+            rows.append(T.tr[T.td[day], [
+                T.td(align='right')[stats.get(name, 0)]
+                for name, _ in COLUMNS]])
+
+        return ctx.tag[
+            T.p[u'Défis en attente\xa0: ',
+                T.b[totals.get('challenges_pending', 0)]],
+            T.table(_class='stats')[rows]]
+
+
+class Admin(rend.Page):
+    """Serves /admin, to the administrator only."""
+
+    child_stats = Stats()
+
+    def locateChild(self, ctx, segments):
+        """Hide the administration pages from the other users."""
+        if not is_admin(ctx):
+            return rend.NotFound
+        return rend.Page.locateChild(self, ctx, segments)
+
+    def renderHTTP(self, ctx):
+        """There is only the statistics, for now."""
+        return url.URL.fromContext(ctx).child('stats')
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Admission control: turn requests away rather than serve them late.
+
+Everything runs in the reactor thread, so under a spike the requests
+wait for each other and the latency grows for everyone. Two signals
+tell that the site is behind:
+
+  - the number of page requests being served at once (the rendering
+    of a page can be spread over several turns of the reactor);
+  - the lag of the reactor: a heartbeat measures how late it runs,
+    which is how long a newly arrived request waits before its turn.
+
+Beyond either limit, page requests get a short 503 response with a
+Retry-After header. Static files and challenge links are cheap, or
+sent by mail and precious, and are always served, as are the metrics,
+which matter most when the site is overloaded.
+"""
+
+from twisted.internet import reactor
+
+from souhaits import metrics
+
+# Body of the responses to the requests turned away
+UNAVAILABLE = (u'Le site est surchargé, merci de réessayer dans quelques'
+               u' instants.\n').encode('utf-8')
+
+
+class Admission(object):
+    """Decides whether requests are served or turned away.
+
+    Args:
+      limit: int, page requests served at once, at most (0: no limit)
+      budget: float, seconds a request may wait for the reactor
+        (0: no limit)
+      clock: IReactorTime
+    """
+
+    # First path segments always served
+    PRIORITY = frozenset(('css', 'images', 'js', 'themes', 'challenge',
+                          'favicon.ico', 'metrics'))
+
+    # Period of the heartbeat measuring the lag, in seconds
+    HEARTBEAT = 0.05
+
+    # Seconds after which the clients turned away may try again
+    RETRY_AFTER = 5
+
+    def __init__(self, limit, budget, clock=reactor):
+        self.limit = limit
+        self.budget = budget
+        self.clock = clock
+        self.in_flight = 0
+        self.lag = 0.0
+        self.expected = None
+        self.call = None
+
+    def start(self):
+        """Start measuring the lag of the reactor."""
+        if self.call is None and self.budget:
+            self._beat()
+
+    def stop(self):
+        """Stop measuring the lag."""
+        if self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+        self.expected = None
+        self.lag = 0.0
+
+    def _beat(self):
+        """Measure how late the heartbeat runs, and schedule the next."""
+        now = self.clock.seconds()
+        if self.expected is not None:
+            self.lag = max(now - self.expected, 0.0)
+            metrics.REACTOR_LAG.set(self.lag)
+        self.expected = now + self.HEARTBEAT
+        self.call = self.clock.callLater(self.HEARTBEAT, self._beat)
+
+    def priority(self, request):
+        """Return whether 'request' is always served."""
+        # Behind the proxy, the paths start with vhost/<scheme>/<host>,
+        # which VHostMonster only consumes during the traversal.
+        segments = request.path.split('/', 5)[1:]
+        if segments[0] == 'vhost':
+            segments = segments[3:]
+        return bool(segments) and segments[0] in self.PRIORITY
+
+    def admit(self, request):
+        """Let 'request' in, if the site can take it.
+
+        Returns:
+          None if the request is served, otherwise the reason why it
+          is turned away ('in_flight' or 'lag')
+        """
+        if self.priority(request):
+            return None
+
+        if self.limit and self.in_flight >= self.limit:
+            reason = 'in_flight'
+        elif self.budget and self.lag > self.budget:
+            reason = 'lag'
+        else:
+            self.in_flight += 1
+            metrics.IN_FLIGHT.set(self.in_flight)
+            request.notifyFinish().addBoth(self._done)
+            return None
+
+        metrics.SHED.inc(reason)
+        return reason
+
+    def _done(self, _):
+        """A page request is finished."""
+        self.in_flight -= 1
+        metrics.IN_FLIGHT.set(self.in_flight)
+
+    def reject(self, request):
+        """Write the 503 response to 'request'; the caller finishes it."""
+        request.setResponseCode(503)
+        request.setHeader('retry-after', str(self.RETRY_AFTER))
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        request.setHeader('cache-control', 'no-store')
+        request.write(UNAVAILABLE)
@@ -0,0 +1,257 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Read-only JSON API.
+
+  /api/lists/<url>         the list itself
+  /api/lists/<url>/items   its items, as the List page shows them
+  /api/me/reservations     the items reserved by the connected user
+
+A 'fields' argument (e.g. fields=key,title) restricts the members of
+the returned objects. The items are paginated like the List page,
+with the 'after' and 'limit' arguments.
+
+The list resources carry an ETag derived from the version of the list,
+so that a revalidation costs no query on the list itself. The ETag of
+the reservations is derived from the versions of the lists where the
+user reserved items: a reservation bumps the version of its list.
+"""
+
+import json
+import md5
+
+from nevow import rend
+from nevow.inevow import IRequest
+from twisted.web import http
+
+from souhaits.core import IService
+from souhaits.session import maybe_user
+from souhaits.web import format_cursor, parse_cursor
+
+# Maximum number of items per response
+MAX_ITEMS = 500
+
+
+def _user(ctx):
+    """Return the connected User, or None."""
+    avatar = maybe_user(ctx)
+    if avatar.anonymous:
+        return None
+    return avatar.user
+
+
+def _fields(request):
+    """Return the set of fields asked for, or None for all of them."""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return frozenset(','.join(fields).split(','))
+
+
+def _select(obj, fields):
+    """Keep the requested fields of a dict."""
+    if fields is None:
+        return obj
+    return dict((k, v) for k, v in obj.items() if k in fields)
+
+
+def list_to_json(lst):
+    """Return the JSON object describing a list."""
+    return {
+        'key': lst.id,
+        'url': lst.url,
+        'name': lst.name,
+        'description': lst.desc,
+        'theme': lst.theme.key,
+        'showres': bool(lst.showres),
+        }
+
+
+def item_to_json(item, user):
+    """Return the JSON object describing an item seen by 'user'."""
+    obj = {
+        'key': item.key,
+        'list': item.list,
+        'title': item.title,
+        'description': item.description,
+        'url': item.url,
+        'score': item.score,
+        'reserved': bool(item.res),
+        'reserved_by_me': bool(item.res and user is not None and
+                               item.res[0] == user.id),
+        }
+    if item.res and item.res[2]:
+        obj['reserved_by'] = item.res[2]
+    return obj
+
+
+class _Resource(rend.Page):
+    """Base of the API resources: JSON output, errors and ETags.
+
+    The resources define content(ctx), which returns the object to
+    serialize.
+    """
+
+    def etag(self, ctx):
+        """Return the ETag of the resource before computing it, or None."""
+        return None
+
+    def renderHTTP(self, ctx):
+        """Render the resource as JSON."""
+        request = IRequest(ctx)
+        request.setHeader('content-type', 'application/json; charset=utf-8')
+        request.setHeader('cache-control', 'private, no-cache')
+
+        etag = self.etag(ctx)
+        if etag is not None:
+            # The representation depends on the arguments and the user
+            user = _user(ctx)
+            etag = '"%s-%s"' % (etag, md5.new(repr((
+                sorted(request.args.items()),
+                user and user.id))).hexdigest()[:12])
+
+            if request.setETag(etag) == http.CACHED:
+                return ''
+
+        return json.dumps(self.content(ctx), separators=(',', ':'))
+
+    def error(self, ctx, code, message):
+        """Return an error response."""
+        IRequest(ctx).setResponseCode(code)
+        return {'error': message}
+
+
+class ListItems(_Resource):
+    """Items of a list."""
+
+    def __init__(self, lst):
+        _Resource.__init__(self)
+        self.list = lst
+
+    def etag(self, ctx):
+        """The items change with the version of the list."""
+        versions = IService(ctx).versions
+        versions.refresh()
+        return '%d-%d' % (self.list.id, versions.get(self.list.id))
+
+    def content(self, ctx):
+        """Return a page of items."""
+        request = IRequest(ctx)
+        user = _user(ctx)
+
+        try:
+            limit = min(int(request.args.get('limit', [MAX_ITEMS])[0]),
+                        MAX_ITEMS)
+        except ValueError:
+            return self.error(ctx, http.BAD_REQUEST, 'invalid limit')
+
+        items, after = IService(ctx).itemsForViewer(
+            self.list, user, parse_cursor(ctx.arg('after')), max(limit, 1))
+
+        fields = _fields(request)
+        return {
+            'items': [_select(item_to_json(i, user), fields) for i in items],
+            'after': after and format_cursor(after),
+            }
+
+
+class List(_Resource):
+    """A single list."""
+
+    def __init__(self, lst):
+        _Resource.__init__(self)
+        self.list = lst
+
+    def etag(self, ctx):
+        """The list changes with its version."""
+        versions = IService(ctx).versions
+        versions.refresh()
+        return '%d-%d' % (self.list.id, versions.get(self.list.id))
+
+    def content(self, ctx):
+        """Return the list."""
+        return _select(list_to_json(self.list), _fields(IRequest(ctx)))
+
+    def child_items(self, _):
+        """The items of the list."""
+        return ListItems(self.list)
+
+
+class Lists(_Resource):
+    """The lists, by URL."""
+
+    def content(self, ctx):
+        """Listing the lists is not allowed."""
+        return self.error(ctx, http.NOT_FOUND, 'no such list')
+
+    def childFactory(self, ctx, name):
+        """Return the list called 'name'."""
+        lst = IService(ctx).getListByURL(name.decode('utf-8'))
+        if lst is None:
+            return None
+        return List(lst)
+
+
+class Reservations(_Resource):
+    """The items reserved by the connected user."""
+
+    def etag(self, ctx):
+        """The reservations change with the versions of their lists."""
+        user = _user(ctx)
+        if user is None:
+            return None
+
+        srv = IService(ctx)
+        srv.versions.refresh()
+        return 'r-' + md5.new(repr([
+            (key, srv.versions.get(key))
+            for key in srv.getUserReservationLists(user)])).hexdigest()[:12]
+
+    def content(self, ctx):
+        """Return the reserved items."""
+        user = _user(ctx)
+        if user is None:
+            return self.error(ctx, http.FORBIDDEN, 'not connected')
+
+        fields = _fields(IRequest(ctx))
+        return {'items': [
+            _select(item_to_json(i, user), fields)
+            for i in IService(ctx).getUserReservations(user)]}
+
+
+class Me(_Resource):
+    """The connected user."""
+
+    child_reservations = Reservations()
+
+    def content(self, ctx):
+        """Return the connected user."""
+        user = _user(ctx)
+        if user is None:
+            return self.error(ctx, http.FORBIDDEN, 'not connected')
+        return _select({'key': user.id, 'email': user.email},
+                       _fields(IRequest(ctx)))
+
+
+class Api(_Resource):
+    """Root of the API."""
+
+    child_lists = Lists()
+    child_me = Me()
+
+    def content(self, ctx):
+        """Return the entry points."""
+        return {'lists': '/api/lists/<url>', 'me': '/api/me'}
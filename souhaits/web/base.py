@@ -20,24 +20,22 @@
 This page is inherited by all the others.
 """
 
-from nevow import rend, loaders
+from nevow import rend
 from nevow.inevow import ISession, IRequest
 
 from nevow import tags as T, stan
 
-from souhaits import TEMPLATE_DIR
 from souhaits.core import IService
-from souhaits.web import login
+from souhaits.web import login, template
 from souhaits.web import theme
 
-from souhaits.session import maybe_user
+from souhaits.session import is_guest, maybe_user
 
 
 class BasePage(rend.Page):
     """ Base class inherited by all the actual pages of the site """
 
-    docFactory = loaders.xmlfile(templateDir=TEMPLATE_DIR,
-                                 template='site.xml')
+    docFactory = template('site.xml')
 
     contentTemplateFile = None
     contentTags         = ''
@@ -79,8 +77,7 @@ class BasePage(rend.Page):
         tag = ctx.tag.clear()
         
         if self.contentTemplateFile:
-            return tag[loaders.xmlfile(templateDir=TEMPLATE_DIR,
-                                       template=self.contentTemplateFile)]
+            return tag[template(self.contentTemplateFile)]
         else:
             return tag[self.contentTags]
 
@@ -90,8 +87,7 @@ class BasePage(rend.Page):
 
         if not user.anonymous:
             tag = ctx.tag.clear()
-            return tag[loaders.xmlfile(templateDir=TEMPLATE_DIR,
-                                       template='listbox.xml') ]
+            return tag[template('listbox.xml')]
         else:
             return ctx.tag[T.em[u"Vous n'êtes pas connecté"]]
 
@@ -103,15 +99,19 @@ class BasePage(rend.Page):
     
     def render_listitem(self, ctx, data):
         """Render a single list in the list box."""
-        data, highlight = data
+        data, unread = data
 
         uri = IRequest(ctx).uri
         target = "/" + data.url
 
-        if highlight:
-            new = T.img(src="/images/newitem.png", alt="",
-                        title="Nouveautés")
-            content = T.b [new, u'\xa0', data.name]
+        if unread:
+            if unread > 1:
+                news = u'%d nouveautés' % unread
+            else:
+                news = u'1 nouveauté'
+            new = T.img(src="/images/newitem.png", alt="", title=news)
+            content = T.b [new, u'\xa0', data.name, T.br,
+                           T.span(_class="unread")[news]]
         else:
             content = data.name
         
@@ -125,11 +125,11 @@ class BasePage(rend.Page):
         
     def data_my_lists(self, ctx, data):
         """Returned the list of the wishlists owned by the user."""
-        return IService(ctx).getListsOwnedBy(maybe_user(ctx).user)
+        return IService(ctx).getSidebar(maybe_user(ctx).user)[0]
     
     def data_friend_lists(self, ctx, data):
         """Returned the list of the wishlists watched by the user."""
-        return IService(ctx).getFriendLists(maybe_user(ctx).user)
+        return IService(ctx).getSidebar(maybe_user(ctx).user)[1]
     
     def render_userbox(self, ctx, data):
         """Render the box containing the user's login status."""
@@ -151,6 +151,8 @@ class BasePage(rend.Page):
             greetings = T.div(_class="userinfo")[
                 warn, T.span(style="padding-right:3em")[email],
                 T.a(href="/")[u"Réservations"],
+                u' :: ', T.a(href="/search")[u"Rechercher"],
+                u' :: ', T.a(href="/export")[u"Exporter"],
                 u' :: ', T.a(href="/logout")[u"Quitter"],
                 ]
 
@@ -167,6 +169,10 @@ class BasePage(rend.Page):
 
     def render_message(self, ctx, data):
         """Render the pending user messages."""
+        # Don't give guests a session just to find it empty
+        if is_guest(ctx):
+            return ''
+
         session = ISession(ctx)
 
         pending = getattr(session, 'message', [])
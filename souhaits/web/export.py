@@ -0,0 +1,206 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Export of a user's data: /export?format=json or /export?format=csv.
+
+The export contains the lists owned by the user with their items and
+co-editors, and the user's open reservations. It is read on its own
+connection, in a single read transaction: in WAL mode, it sees a
+consistent snapshot and never holds back the writer. Records are
+generated from the database cursors and written as the client reads
+them, so the memory used does not depend on the size of the export.
+"""
+
+import csv
+import json
+
+from cStringIO import StringIO
+
+from nevow import rend, url
+from nevow.inevow import IRequest
+from twisted.internet import defer, interfaces
+from twisted.python import log
+from zope.interface import implements  # pylint: disable-msg=F0401
+
+from souhaits.core import IService
+from souhaits.session import maybe_user
+
+# Number of records written each time the client is ready for more
+RECORDS_PER_WRITE = 200
+
+# Columns of the CSV export
+CSV_COLUMNS = ('type', 'list', 'name', 'title', 'description', 'url',
+               'score', 'email')
+
+
+def records(cx, user):
+    """Generate the records of the export of 'user', as dicts."""
+    lists = cx.cursor()
+    lists.execute('SELECT key, url, name, description, showres, theme'
+                  ' FROM wishlist WHERE owner = ? ORDER BY key', (user.id,))
+
+    for key, list_url, name, description, showres, theme in lists:
+        yield {'type': 'list', 'list': list_url, 'name': name,
+               'description': description, 'showres': bool(showres),
+               'theme': theme}
+
+        cu = cx.cursor()
+        cu.execute('SELECT u.email FROM coeditor c, user u'
+                   ' WHERE c.list = ? AND u.key = c.user', (key,))
+        for (email,) in cu:
+            yield {'type': 'coeditor', 'list': list_url, 'email': email}
+
+        # The reservations on the user's own lists are not exported:
+        # the list page does not show them either by default.
+        cu.execute('SELECT title, description, url, score FROM item'
+                   ' WHERE list = ?'
+                   ' ORDER BY score DESC, modification DESC, key DESC',
+                   (key,))
+        for title, item_description, item_url, score in cu:
+            yield {'type': 'item', 'list': list_url, 'title': title,
+                   'description': item_description, 'url': item_url,
+                   'score': score}
+
+    cu = cx.cursor()
+    cu.execute("SELECT w.url, w.name, i.title, i.description, i.url, i.score"
+               " FROM reservation r, item i, wishlist w"
+               " WHERE r.owner = ? AND r.status = 'R' AND i.key = r.item"
+               " AND w.key = i.list ORDER BY r.key", (user.id,))
+    for list_url, name, title, description, item_url, score in cu:
+        yield {'type': 'reservation', 'list': list_url, 'name': name,
+               'title': title, 'description': description, 'url': item_url,
+               'score': score}
+
+
+def json_chunks(recs):
+    """Generate a JSON array of the records, piece by piece."""
+    separator = '[\n'
+    for rec in recs:
+        yield separator + json.dumps(rec, sort_keys=True)
+        separator = ',\n'
+
+    if separator == '[\n':
+        yield '[]\n'
+    else:
+        yield '\n]\n'
+
+
+def _csv_value(value):
+    """Return the CSV cell for a value."""
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def csv_chunks(recs):
+    """Generate the records as CSV lines, one record per line."""
+    out = StringIO()
+    writer = csv.writer(out)
+
+    writer.writerow(CSV_COLUMNS)
+    for rec in recs:
+        writer.writerow([_csv_value(rec.get(c)) for c in CSV_COLUMNS])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+    yield out.getvalue()
+
+
+class _Producer(object):
+    """Write chunks to a request when the client is ready for them.
+
+    'done' fires when everything has been written or the client has
+    gone away.
+    """
+
+    implements(interfaces.IPullProducer)
+
+    def __init__(self, request, chunks, cx):
+        self.request = request
+        self.chunks = chunks
+        self.cx = cx
+        self.done = defer.Deferred()
+
+    def start(self):
+        """Start writing."""
+        self.request.registerProducer(self, False)
+
+    def _stop(self, result):
+        """Release the connection and fire 'done'."""
+        if self.cx is None:
+            return
+        self.cx.close()
+        self.cx = None
+        self.request.unregisterProducer()
+        self.done.callback(result)
+
+    def resumeProducing(self):
+        """Write the next records."""
+        data = []
+        try:
+            for _ in xrange(RECORDS_PER_WRITE):
+                data.append(self.chunks.next())
+        except StopIteration:
+            self.request.write(''.join(data))
+            self._stop('')
+            return
+        except Exception:  # pylint: disable-msg=W0703
+            log.err(None, 'export failed')
+            self._stop('')
+            return
+
+        self.request.write(''.join(data))
+
+    def stopProducing(self):
+        """The client is gone."""
+        self._stop('')
+
+
+class Export(rend.Page):
+    """Serves /export."""
+
+    FORMATS = {
+        'json': ('application/json; charset=utf-8', json_chunks),
+        'csv': ('text/csv; charset=utf-8', csv_chunks),
+        }
+
+    def renderHTTP(self, ctx):
+        """Stream the export of the connected user."""
+        avatar = maybe_user(ctx)
+        if not avatar.identified:
+            return url.URL.fromString('/login')
+
+        request = IRequest(ctx)
+        name = ctx.arg('format') or 'json'
+        if name not in self.FORMATS:
+            name = 'json'
+        content_type, chunks = self.FORMATS[name]
+
+        request.setHeader('content-type', content_type)
+        request.setHeader('content-disposition',
+                          'attachment; filename="mes-souhaits.%s"' % name)
+
+        # An explicit transaction makes all the queries read the same
+        # snapshot of the database.
+        # pylint: disable-msg=E1101
+        cx = IService(ctx).connect()
+        cx.isolation_level = None
+        cx.execute('BEGIN')
+
+        producer = _Producer(request, chunks(records(cx, avatar.user)), cx)
+        producer.start()
+        return producer.done
@@ -21,16 +21,14 @@ This module provides the login page and a login fragment to be
 embedded in other pages.
 """
 
-from nevow import loaders
 from nevow import rend
 from nevow import tags as T
 from nevow import url
 from nevow.inevow import IRequest
 
-from souhaits import TEMPLATE_DIR
 from souhaits.core import IService, validate_email
 from souhaits.session import must_user, message
-from souhaits.web import widget
+from souhaits.web import template, widget
 
 class LoginInfo(object):
     """Hold all the login form information."""
@@ -68,8 +66,7 @@ def login_info_from_context(ctx):
 
 class LoginFragment(rend.Fragment, widget.RoundedBoxMixin):
     """Fragment displaying a login box."""
-    docFactory = loaders.xmlfile(templateDir=TEMPLATE_DIR,
-                                 template='login_box.xml')
+    docFactory = template('login_box.xml')
 
     def render_login_warnings(self, ctx, data):
         """Render the login errors."""
@@ -0,0 +1,50 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Monitoring endpoints, only reachable from the server itself."""
+
+from nevow import rend
+from nevow.inevow import IRequest
+from twisted.web import http
+
+from souhaits import metrics
+
+LOCAL_ADDRESSES = frozenset(('127.0.0.1', '::1'))
+
+
+def is_local(request):
+    """Return True if the request comes from the machine itself.
+
+    Requests relayed by a front-end proxy carry an X-Forwarded-For
+    header: they come from the outside even if the proxy is local.
+    """
+    return (request.getClientIP() in LOCAL_ADDRESSES
+            and not request.getHeader('x-forwarded-for'))
+
+
+class Metrics(rend.Page):
+    """Serves /metrics in the Prometheus text format."""
+
+    def renderHTTP(self, ctx):
+        """Render the metrics."""
+        request = IRequest(ctx)
+
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        if not is_local(request):
+            request.setResponseCode(http.FORBIDDEN)
+            return 'forbidden\n'
+
+        return metrics.REGISTRY.render()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Full-text search in the lists of the user."""
+
+from nevow import tags as T, url
+from nevow.inevow import IRequest
+
+from souhaits import core
+from souhaits.core import IService
+from souhaits.session import maybe_user
+from souhaits.web import arg
+from souhaits.web.base import BasePage
+
+
+def highlight(snippet):
+    """Turn a search snippet into stan, with the matches in bold."""
+    parts = []
+    for chunk in snippet.split(core.SNIPPET_START):
+        if core.SNIPPET_END in chunk:
+            match, rest = chunk.split(core.SNIPPET_END, 1)
+            parts.append(T.b[match])  # pylint: disable-msg=E1101
+            parts.append(rest)
+        else:
+            parts.append(chunk)
+    return parts
+
+
+class Search(BasePage):
+    """Serves /search."""
+    contentTemplateFile = 'search.xml'
+
+    # Number of items per page of results
+    ITEMS_PER_PAGE = 20
+
+    def __init__(self):
+        BasePage.__init__(self, u'Rechercher')
+
+    def render_query(self, ctx, _):
+        """Render the search field."""
+        return ctx.tag(value=arg(IRequest(ctx), 'q'))
+
+    def render_results(self, ctx, _):
+        """Render the lists and the items found."""
+        # pylint: disable-msg=E1101
+        request = IRequest(ctx)
+        query = arg(request, 'q')
+        if not query:
+            return ''
+
+        avatar = maybe_user(ctx)
+        if not avatar.identified:
+            return ctx.tag[T.em[u'Vous devez être connecté pour rechercher.']]
+
+        try:
+            start = max(int(arg(request, 'start', '0')), 0)
+        except ValueError:
+            start = 0
+
+        srv = IService(ctx)
+        content = []
+
+        if not start:
+            lsts = srv.searchLists(avatar.user, query)
+            if lsts:
+                content.append(T.h2[u'Listes'])
+                content.append(T.ul[[
+                    T.li[T.a(href='/' + lst.url)[
+                        lst.name or T.i[u'Liste sans nom']]]
+                    for lst in lsts]])
+
+        found = srv.searchItems(avatar.user, query, start,
+                                self.ITEMS_PER_PAGE + 1)
+        if found:
+            content.append(T.h2[u'Souhaits'])
+            content.append(T.ul[[
+                T.li[T.a(href='/%s/%d' % (lst.url, item.key))[
+                    item.title or T.i[u'Souhait sans titre']],
+                     u' — ', T.i[lst.name or u'Liste sans nom'],
+                     T.br, highlight(snippet or u'')]
+                for item, lst, snippet in found[:self.ITEMS_PER_PAGE]]])
+
+        links = []
+        here = url.URL.fromContext(ctx).remove('start')
+        if start:
+            links.append(T.a(href=here.add(
+                'start', str(max(start - self.ITEMS_PER_PAGE, 0))))[
+                u'« Précédents'])
+        if len(found) > self.ITEMS_PER_PAGE:
+            if links:
+                links.append(' :: ')
+            links.append(T.a(href=here.add(
+                'start', str(start + self.ITEMS_PER_PAGE)))[u'Suivants »'])
+        if links:
+            content.append(T.div(_class="listaction")[links])
+
+        if not content:
+            content = T.em[u'Aucun résultat.']
+        return ctx.tag[content]
@@ -0,0 +1,203 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""The web site, with per-request accounting."""
+
+import time
+
+from nevow import appserver
+from twisted.internet import defer, reactor
+
+from souhaits import metrics, profiling
+
+
+def add_time(request, phase, seconds):
+    """Account for 'seconds' spent by 'request' in 'phase'."""
+    timings = getattr(request, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def _ms(seconds):
+    """Convert a duration to milliseconds, for the logs."""
+    return round(1000 * seconds, 2)
+
+
+def next_turn(request, clock=reactor):
+    """Return a Deferred fired on the next turn of the reactor.
+
+    What its callbacks run, until they wait for another Deferred, is
+    charged to 'request'.
+    """
+    d = defer.Deferred()
+    clock.callLater(0, request.charged, d.callback, '')
+    return d
+
+
+class Cost(object):
+    """What a request cost, named like the totals of core.Service."""
+
+    sql_statements = 0
+    sql_seconds = 0.0
+    mail_seconds = 0.0
+
+
+class Request(appserver.NevowRequest):
+    """A request that records what it cost to serve.
+
+    A page can be rendered over several turns of the reactor, in
+    between other requests: the cost of a request is what runs while
+    it is set as the account of the service, during its processing and
+    the turns scheduled with next_turn. The reservations written in
+    batches are shared, and charged to no request.
+
+    Members:
+      page: name of the class of the rendered page
+      started: time at which the processing started
+      rendered: time at which the rendering started
+      timings: dict of time spent in named phases (see add_time)
+      account: Cost of the request
+    """
+
+    page = None
+    rendered = None
+    timings = None
+    account = None
+
+    def process(self):
+        """Start processing the request."""
+        # The channel is gone by the time the request is finished
+        self.service = srv = self.channel.site.service
+
+        self.started = time.time()
+        self.timings = {}
+        self.account = Cost()
+        self.notifyFinish().addBoth(self._account)
+
+        if srv.debug and profiling.wants_profile(self):
+            profile = profiling.RequestProfile(srv, self)
+            profile.start()
+            self.notifyFinish().addBoth(profile.stop)
+
+        admission = self.channel.site.admission
+        if admission is not None and admission.admit(self) is not None:
+            admission.reject(self)
+            self.finishRequest(True)
+            return None
+
+        return self.charged(appserver.NevowRequest.process, self)
+
+    def charged(self, f, *args):
+        """Call f(*args), charging what it runs to this request."""
+        srv = self.service
+        previous, srv.account = srv.account, self.account
+        try:
+            return f(*args)
+        finally:
+            srv.account = previous
+
+    def gotPageContext(self, pageContext):
+        """Remember which page is rendered."""
+        self.rendered = time.time()
+        if pageContext is not appserver.errorMarker:
+            self.page = pageContext.tag.__class__.__name__
+        return appserver.NevowRequest.gotPageContext(self, pageContext)
+
+    def cost(self):
+        """Return the SQL statements, SQL time and mail time so far."""
+        account = self.account
+        return (account.sql_statements, account.sql_seconds,
+                account.mail_seconds)
+
+    def access_entry(self):
+        """Return the access log entry for this request.
+
+        The session, SQL and mail times overlap with the routing and
+        rendering times.
+        """
+        now = time.time()
+        statements, sql, mail = self.cost()
+
+        if self.rendered is None:
+            route, render = now - self.started, 0.0
+        else:
+            route, render = self.rendered - self.started, now - self.rendered
+
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                  time.gmtime(self.started)),
+            'method': self.method,
+            'path': self.path.decode('utf-8', 'replace'),
+            'page': self.page,
+            'status': self.code,
+            'bytes': self.sentLength,
+            'ms': _ms(now - self.started),
+            'route_ms': _ms(route),
+            'render_ms': _ms(render),
+            'session_ms': _ms(self.timings.get('session', 0.0)),
+            'db_ms': _ms(sql),
+            'sql': statements,
+            'mail_ms': _ms(mail),
+            }
+
+    def _account(self, _):
+        """Record the cost of this request in the metrics."""
+        page = self.page or 'unknown'
+
+        statements, sql, _ = self.cost()
+        metrics.REQUESTS.inc(page)
+        metrics.REQUEST_SECONDS.observe(time.time() - self.started, page)
+        metrics.REQUEST_SQL_STATEMENTS.observe(statements, page)
+        metrics.REQUEST_SQL_SECONDS.observe(sql, page)
+
+
+class Site(appserver.NevowSite):
+    """The mes-souhaits web site.
+
+    Args:
+      resource: the root resource
+      srv: core.Service
+      access_log: accesslog.AccessLog or None
+      admission: admission.Admission or None
+    """
+
+    requestFactory = Request
+
+    def __init__(self, resource, srv, access_log=None, admission=None,
+                 *args, **kw):
+        appserver.NevowSite.__init__(self, resource, *args, **kw)
+        self.service = srv
+        self.access_log = access_log
+        self.admission = admission
+
+    def startFactory(self):
+        """Start listening: watch the load."""
+        appserver.NevowSite.startFactory(self)
+        if self.admission is not None:
+            self.admission.start()
+
+    def stopFactory(self):
+        """Stop listening."""
+        if self.admission is not None:
+            self.admission.stop()
+        appserver.NevowSite.stopFactory(self)
+
+    def log(self, request):
+        """Log a finished request."""
+        appserver.NevowSite.log(self, request)
+
+        if self.access_log is not None and request.timings is not None:
+            self.access_log.write(request.access_entry())
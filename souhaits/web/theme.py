@@ -15,40 +15,68 @@
 #
 # You should have received a copy of the GNU Affero General Public License along
 # with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
-"""Theme handling."""
+"""Theme handling.
+
+The title and the 'reserved' lock of each theme are flattened once,
+when the module is loaded: rendering them only escapes the text.
+"""
 
 from nevow import tags as T
 from souhaits.web import widget
+from souhaits.web.widget import HOLE
+
+
+def _lock(src, **kw):
+    """Return the template of a 'reserved' lock image."""
+    # pylint: disable-msg=E1101
+    return widget.FlatTemplate(T.img(src=src, alt=HOLE, title=HOLE,
+                                     style="margin-right: 1ex", **kw))
+
+
+def _picture_title(src):
+    """Return the template of a title with a picture on its right."""
+    # pylint: disable-msg=E1101
+    return widget.FlatTemplate([T.img(src=src, align="right"), T.h1[HOLE]])
 
 
 class Theme(object):
-    """Base class for UI themes."""
+    """Base class for UI themes.
+
+    Members:
+      title: widget.FlatTemplate of the list title
+      lock: widget.FlatTemplate of the 'reserved' lock
+    """
     name = None
     key = None
 
+    title = None
+    lock = None
+
     def __eq__(self, other):
         """Check the equivalence between 2 themes."""
         return self.key == other.key
 
+    def render_ListTitle(self, _, data):
+        """Render the list title."""
+        return self.title.fill(data)
 
-class Default(Theme, widget.RoundedBoxMixin):
+    def render_Lock(self, _, data):
+        """Render the 'reserved' lock."""
+        return self.lock.fill(data)
+
+
+class Default(Theme):
     """Default theme (large rounded box around the title)."""
 
     key = 'default'
     name = 'Classique'
 
-    def render_ListTitle(self, _, data):
-        """Render the list title."""
-        # pylint: disable-msg=E1101
-        return T.div(render=self.render_small_rounded_box, _class="listtitle")[
-            T.h1(style="color:white; padding: 1ex")[data]]
+    # pylint: disable-msg=E1101,W0212
+    title = widget.FlatTemplate(widget.RoundedBoxMixin()._make_fragment(
+        T.div(_class="listtitle")[
+            T.h1(style="color:white; padding: 1ex")[HOLE]], False))
+    lock = _lock("/images/reserve.png", width="23", height="23")
 
-    def render_Lock(self, _, data):
-        """Render the 'reserved' lock."""
-        # pylint: disable-msg=E1101
-        return T.img(src="/images/reserve.png", width="23", height="23",
-                     alt=data, title=data, style="margin-right: 1ex")
-        
 
 class XMas(Theme):
     """Christmas theme."""
@@ -56,36 +84,19 @@ class XMas(Theme):
     key = 'xmas'
     name = u'Noël'
 
-    def render_ListTitle(self, _, data):
-        """Render the list title."""
-        # pylint: disable-msg=E1101
-        return [T.img(src="/themes/xmas/xmas.png",
-                      align="right"), T.h1[data]]
+    title = _picture_title("/themes/xmas/xmas.png")
+    lock = _lock("/themes/xmas/lock.png")
+
 
-    def render_Lock(self, _, data):
-        """Render the 'reserved' lock."""
-        # pylint: disable-msg=E1101
-        return T.img(src="/themes/xmas/lock.png",
-                     alt=data, title=data, style="margin-right: 1ex")
-        
 class Baby(Theme):
     """Baby theme."""
 
     key = 'baby'
     name = u'Naissance'
 
-    def render_ListTitle(self, _, data):
-        """Render the list title."""
-        # pylint: disable-msg=E1101
-        return [T.img(src="/themes/baby/baby.png",
-                      align="right"), T.h1[data]]
+    title = _picture_title("/themes/baby/baby.png")
+    lock = _lock("/themes/baby/coeur.png")
 
-    def render_Lock(self, _, data):
-        """Render the 'reserved' lock."""
-        # pylint: disable-msg=E1101
-        return T.img(src="/themes/baby/coeur.png",
-                     alt=data, title=data, style="margin-right: 1ex")
-        
 
 class Birthday(Theme):
     """Birthday theme."""
@@ -93,18 +104,9 @@ class Birthday(Theme):
     key = 'bday'
     name = u'Anniversaire'
 
-    def render_ListTitle(self, _, data):
-        """Render the list title."""
-        # pylint: disable-msg=E1101
-        return [T.img(src="/themes/bday/bday.png",
-                      align="right"), T.h1[data]]
+    title = _picture_title("/themes/bday/bday.png")
+    lock = _lock("/themes/bday/lock.png")
 
-    def render_Lock(self, _, data):
-        """Render the 'reserved' lock."""
-        # pylint: disable-msg=E1101
-        return T.img(src="/themes/bday/lock.png",
-                     alt=data, title=data, style="margin-right: 1ex")
-        
 
 class Doudou(Theme):
     """Doudou theme."""
@@ -112,18 +114,9 @@ class Doudou(Theme):
     key = 'doudou'
     name = u'Doudou'
 
-    def render_ListTitle(self, _, data):
-        """Render the list title."""
-        # pylint: disable-msg=E1101
-        return [T.img(src="/themes/doudou/doudou.png",
-                      align="right"), T.h1[data]]
+    title = _picture_title("/themes/doudou/doudou.png")
+    lock = _lock("/themes/doudou/lock.png")
 
-    def render_Lock(self, _, data):
-        """Render the 'reserved' lock."""
-        # pylint: disable-msg=E1101
-        return T.img(src="/themes/doudou/lock.png",
-                     alt=data, title=data, style="margin-right: 1ex")
-        
 
 themes = {}
 for theme in (Default, XMas, Baby, Birthday, Doudou):
@@ -17,13 +17,68 @@
 # with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
 """Various widgets to help in consistency and conciseness."""
 
-from nevow import tags as T
+from nevow import flat, tags as T
+
+# Stands for the data in the stan of a FlatTemplate
+HOLE = '\x00'
+
+
+class FlatTemplate(object):
+    """Markup flattened once, with holes filled at each render.
+
+    Args:
+      tag: stan, where HOLE stands for the data, as text or in
+        attribute values
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.parts = flat.flatten(tag).split(HOLE)
+
+    def fill(self, data):
+        """Return the markup with the holes filled with 'data' (a string)."""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # Escaped as nevow does for attributes, which is also fine for text
+        data = data.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '>', '&gt;').replace('"', '&quot;')
+        return T.xml(data.join(self.parts))
+
+
+# Markup of the stars of each score, flattened on first use
+_STARS = {}
+
+
+def stars(score):
+    """Return the stars corresponding to a score of 'score'."""
+    try:
+        return _STARS[score]
+    except KeyError:
+        pass
+
+    # pylint: disable-msg=E1101
+    code = []
+    for value in (1, 2, 3):
+        if value > score:
+            code.append(T.img(src="/images/star-off.png"))
+        else:
+            code.append(T.img(src="/images/star-on.png"))
+
+    _STARS[score] = T.xml(flat.flatten(code))
+    return _STARS[score]
 
 
 class RoundedBoxMixin(object):
-    """Mixing providing rounded boxes."""
+    """Mixing providing rounded boxes.
+
+    In compiled mode, the divs drawing the box are flattened once: only
+    the outer div, which carries the attributes of the tag, and the
+    content of the box are flattened at each render.
+    """
     # pylint: disable-msg=E1101
 
+    compiled = True
+
     def render_rounded_box(self, ctx, _):
         """Place the current tag in a rounded box.
 
@@ -54,16 +109,25 @@ class RoundedBoxMixin(object):
         """
         return self._make_fragment(ctx.tag, False)
 
-    def _make_fragment(self, tag, add_padding):
-        """Generate markup for a rounded box."""
-        core = tag.children
+    @staticmethod
+    def _box(core, add_padding):
+        """Return the divs drawing a box around 'core'."""
         if add_padding:
             core = T.div(_class="boxcontent")[core]
 
-        fragment = T.div[
-            T.div(_class="br")[
+        return T.div(_class="br")[
             T.div(_class="tl")[
-            T.div(_class="tr")[core]]]]
+            T.div(_class="tr")[core]]]
+
+    def _make_fragment(self, tag, add_padding):
+        """Generate markup for a rounded box."""
+        if self.compiled:
+            head, tail = _BOXES[add_padding]
+            core = [head, tag.children, tail]
+        else:
+            core = self._box(tag.children, add_padding)
+
+        fragment = T.div[core]
 
         # keep the parent's flags, but be careful to merge the class
         classes = [c for c in tag.attributes.get('class').split(' ') if c]
@@ -71,3 +135,12 @@ class RoundedBoxMixin(object):
         fragment.attributes.update(tag.attributes)
         fragment.attributes['class'] = ' '.join(classes)
         return fragment
+
+
+def _compile_box(add_padding):
+    """Return the markup before and after the content of a box."""
+    head, tail = flat.flatten(RoundedBoxMixin._box(
+        HOLE, add_padding)).split(HOLE)
+    return T.xml(head), T.xml(tail)
+
+_BOXES = {True: _compile_box(True), False: _compile_box(False)}
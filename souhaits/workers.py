@@ -0,0 +1,222 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+"""Multi-process serving.
+
+The supervisor (WorkerPool) opens the listening socket and runs
+several worker processes sharing it; the kernel spreads the incoming
+connections among them. Each worker has its own database connection
+(the database is in WAL mode, so readers do not wait on the writer).
+Only worker 0 runs the background tasks (GC,...).
+
+A worker that dies is restarted after RESTART_DELAY seconds.
+
+The worker side is run as: python -m souhaits.workers --index N
+"""
+
+import optparse
+import os
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import log
+
+import souhaits
+
+# Seconds before restarting a dead worker
+RESTART_DELAY = 1.0
+
+# File descriptor of the listening socket, in the workers
+LISTEN_FD = 3
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """Relay the output of a worker to the log, notice its death."""
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.ended = defer.Deferred()
+        self.buffer = ''
+
+    def outReceived(self, data):
+        """Log the complete lines written by the worker."""
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            log.msg('[worker %d] %s' % (self.index, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        """The worker is gone."""
+        if self.buffer:
+            log.msg('[worker %d] %s' % (self.index, self.buffer))
+        self.pool.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerPool(service.Service):
+    """Supervisor of the worker processes.
+
+    Args:
+      port: int, TCP port to listen on
+      count: int, number of workers
+      debug: bool, if True run the workers in debug mode
+      max_in_flight: int, page requests served at once by a worker
+      queue_budget: float, seconds a request may wait in a worker
+    """
+
+    def __init__(self, port, count, debug, max_in_flight, queue_budget):
+        self.port = port
+        self.count = count
+        self.debug = debug
+        self.max_in_flight = max_in_flight
+        self.queue_budget = queue_budget
+        self.socket = None
+        self.workers = {}
+
+    def startService(self):
+        """Create the database if needed, listen and spawn the workers."""
+        service.Service.startService(self)
+
+        from souhaits import application, core
+
+        # Create the database before the workers race to do it
+        srv = core.Service(application.base_url(self.debug),
+                           debug=self.debug, background=False)
+        srv.startService()
+        srv.stopService()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', self.port))
+        self.socket.listen(50)
+        self.socket.setblocking(False)
+
+        for index in range(self.count):
+            self.spawn(index)
+
+    def stopService(self):
+        """Terminate the workers, and wait for them."""
+        service.Service.stopService(self)
+
+        ended = []
+        for worker in self.workers.values():
+            ended.append(worker.ended)
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception, e:  # pylint: disable-msg=W0703
+                log.msg('cannot stop worker %d: %s' % (worker.index, e))
+
+        def _close(_):
+            self.socket.close()
+        return defer.DeferredList(ended).addCallback(_close)
+
+    def spawn(self, index):
+        """Start worker number 'index'."""
+        if not self.running:
+            return
+
+        args = [sys.executable, '-m', 'souhaits.workers', '--index',
+                str(index), '--max-in-flight', str(self.max_in_flight),
+                '--queue-budget', repr(self.queue_budget)]
+        if self.debug:
+            args.append('--debug')
+
+        # Make sure the workers find the same souhaits package
+        env = dict(os.environ)
+        top = os.path.dirname(os.path.dirname(
+            os.path.abspath(souhaits.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [top] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep)
+                     if p])
+
+        worker = _WorkerProtocol(self, index)
+        reactor.spawnProcess(
+            worker, sys.executable, args, env=env, path=os.getcwd(),
+            childFDs={0: 'w', 1: 'r', 2: 'r',
+                      LISTEN_FD: self.socket.fileno()})
+        self.workers[index] = worker
+        log.msg('started worker %d (pid %d)' % (index, worker.transport.pid))
+
+    def workerEnded(self, worker, reason):
+        """Restart a worker that died."""
+        if self.workers.get(worker.index) is not worker:
+            return
+        del self.workers[worker.index]
+
+        if self.running:
+            log.msg('worker %d died (%s), restarting' % (
+                worker.index, reason.value))
+            reactor.callLater(RESTART_DELAY, self.spawn, worker.index)
+
+
+def _watch_parent(parent):
+    """Stop the worker when the supervisor is gone."""
+    if os.getppid() != parent and reactor.running:
+        log.msg('supervisor is gone, exiting')
+        reactor.stop()
+
+
+def _emit(event):
+    """Write a log event to stdout, without a timestamp.
+
+    The supervisor adds its own when relaying the line.
+    """
+    text = log.textFromEventDict(event)
+    if text is not None:
+        sys.stdout.write(text.replace('\n', '\n\t') + '\n')
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    """Run a worker process."""
+    from souhaits import application
+
+    parser = optparse.OptionParser()
+    parser.add_option('--index', type='int', default=0)
+    parser.add_option('--debug', action='store_true', default=False)
+    parser.add_option('--max-in-flight', type='int',
+                      default=application.MAX_IN_FLIGHT)
+    parser.add_option('--queue-budget', type='float',
+                      default=application.QUEUE_BUDGET)
+    options, _ = parser.parse_args(argv)
+
+    log.startLoggingWithObserver(_emit, setStdout=False)
+
+    root = service.MultiService()
+    site = application.make_site(
+        root, options.debug, background=options.index == 0,
+        access_log=application.ACCESS_LOG_WORKER % options.index,
+        max_in_flight=options.max_in_flight,
+        queue_budget=options.queue_budget)
+
+    root.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', root.stopService)
+
+    reactor.adoptStreamPort(LISTEN_FD, socket.AF_INET, site)
+    os.close(LISTEN_FD)
+
+    task.LoopingCall(_watch_parent, os.getppid()).start(1.0, now=False)
+
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+import uts
+
+from twisted.internet import defer, task
+
+from souhaits.web import admission
+
+
+class FakeRequest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.finished = defer.Deferred()
+        self.code = None
+        self.headers = {}
+        self.written = []
+
+    def notifyFinish(self):
+        return self.finished
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished.callback(None)
+
+
+class TestAdmission(object):
+
+    def test_in_flight(self):
+        adm = admission.Admission(2, 0, task.Clock())
+        first, second = FakeRequest('/a'), FakeRequest('/b')
+        assert adm.admit(first) is None
+        assert adm.admit(second) is None
+
+        shed = FakeRequest('/c')
+        assert adm.admit(shed) == 'in_flight'
+        adm.reject(shed)
+        assert shed.code == 503
+        assert shed.headers['retry-after'] == '5'
+
+        # Static files and challenges are served anyway
+        assert adm.admit(FakeRequest('/css/base.css')) is None
+        assert adm.admit(FakeRequest('/challenge/abcd')) is None
+        assert adm.admit(FakeRequest('/metrics')) is None
+        assert adm.admit(FakeRequest('/favicon.ico')) is None
+
+        # Also behind the proxy
+        vhost = '/vhost/http/www.mes-souhaits.net:80'
+        assert adm.admit(FakeRequest(vhost + '/css/base.css')) is None
+        assert adm.admit(FakeRequest(vhost + '/metrics')) is None
+        assert adm.admit(FakeRequest(vhost + '/c')) == 'in_flight'
+        assert adm.admit(FakeRequest(vhost)) == 'in_flight'
+
+        first.finish()
+        assert adm.in_flight == 1
+        assert adm.admit(FakeRequest('/c')) is None
+
+    def test_lag(self):
+        clock = task.Clock()
+        adm = admission.Admission(0, 0.5, clock)
+        adm.start()
+
+        clock.advance(adm.HEARTBEAT)
+        assert adm.admit(FakeRequest('/a')) is None
+
+        # The reactor was blocked for a second
+        clock.advance(adm.HEARTBEAT + 1.0)
+        assert adm.admit(FakeRequest('/a')) == 'lag'
+        assert adm.admit(FakeRequest('/images/logo.png')) is None
+
+        clock.advance(adm.HEARTBEAT)
+        assert adm.admit(FakeRequest('/a')) is None
+
+        adm.stop()
+        assert not clock.getDelayedCalls()
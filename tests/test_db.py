@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 # This file is part of Mes-Souhaits.
 #
 # Copyright (c) 2016 Frederic Gobry
@@ -15,9 +16,17 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
 import uts
+import json
 import os
+import shutil
 
-from souhaits import core
+from twisted.internet import task
+from twisted.python import log
+from twisted.web.test.requesthelper import DummyChannel
+
+from souhaits import backup, core
+from souhaits import web
+from souhaits.web import export, site
 
 class TestDB(object):
     
@@ -55,3 +64,578 @@ class TestDB(object):
         # second time, no email
         assert self.db.donatedItem(user_b, item)
         assert not uts.read_email()
+
+    def test_slow_query_log(self):
+        """Slow statements are logged with their caller and plan."""
+        messages = []
+        observer = lambda event: messages.append(log.textFromEventDict(event))
+        log.addObserver(observer)
+        try:
+            self.db.querylog.threshold = 0
+            self.db.getUserByEmail('nobody@foo.com')
+        finally:
+            self.db.querylog.threshold = self.db.SLOW_QUERY
+            log.removeObserver(observer)
+
+        slow = [m for m in messages if m.startswith('slow query')]
+        assert len(slow) == 1
+        assert ' in getUserByEmail: ' in slow[0]
+        assert 'plan: ' in slow[0]
+
+        sql = 'SELECT key, email FROM user WHERE email = ?'
+        assert self.db.querylog.summary[sql][0] >= 1
+
+    def test_request_cost(self):
+        """Requests served over several turns are charged their own SQL."""
+        clock = task.Clock()
+        first, second = site.Request(DummyChannel()), site.Request(
+            DummyChannel())
+        for request in (first, second):
+            request.service = self.db
+            request.account = site.Cost()
+
+        def _query(_):
+            self.db.getUserByEmail('nobody@foo.com')
+
+        first.charged(_query, None)
+        site.next_turn(second, clock).addCallback(_query)
+        site.next_turn(first, clock).addCallback(_query)
+        _query(None)
+        clock.advance(0)
+
+        assert first.cost()[0] == 2 * second.cost()[0] > 0
+        assert self.db.account is None
+
+    def test_list_cache_across_processes(self):
+        """A list cached by one process is reloaded after another edits it."""
+        user_a, list_a = self.create_user_and_list(u'a')
+
+        assert self.db.getListByKey(list_a.id).name == u'a'
+        assert self.db.getListByKey(list_a.id) is \
+            self.db.getListByKey(list_a.id)
+
+        other = self.db.connect()
+        other.execute('UPDATE wishlist SET name = ? WHERE key = ?',
+                      (u'renamed', list_a.id))
+        other.commit()
+        other.close()
+
+        assert self.db.getListByKey(list_a.id).name == u'renamed'
+
+    def test_list_version(self):
+        """Item changes bump the version of their list."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        versions = self.db.versions
+
+        versions.refresh()
+        before = versions.get(list_a.id)
+
+        item_id = self.db.addNewItem(list_a, 'foo', 'foo', 'foo')
+        versions.refresh()
+        assert versions.get(list_a.id) > before
+
+        before = versions.get(list_a.id)
+        item = self.db.getListItem(list_a, item_id)
+        self.db.deleteItem(item, warn=False)
+        versions.refresh()
+        assert versions.get(list_a.id) > before
+
+    def test_versioned_cache_put_version(self):
+        """A value is stored with the version it was computed from."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        pages = self.db.guest_pages
+
+        assert pages.get('page') is None
+        version = self.db.versions.get(list_a.id)
+
+        # The list changes while the value is being computed
+        self.db.addNewItem(list_a, 'foo', 'foo', 'foo')
+        self.db.versions.refresh()
+
+        pages.put('page', list_a.id, 'stale', version)
+        assert pages.get('page') is None
+
+    def test_list_events(self):
+        """Item and reservation changes are logged as list events."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        item_id = self.db.addNewItem(list_a, 'foo', 'foo', 'foo')
+        item = self.db.getListItem(list_a, item_id)
+        self.db.editItem(item, 'bar', 'bar', 'bar', 2)
+        self.db.reserveItem(user_b, item)
+        self.db.giveupItem(user_b, item)
+        self.db.reserveItem(user_b, item)
+        self.db.donatedItem(user_b, item)
+        self.db.updateList(list_a, description=u'new')
+
+        events = self.db.eventsSince(0, list_a)
+        assert ''.join([e.kind for e in events]) == 'curgrDl'
+        assert [e.item for e in events[:-1]] == [item_id] * 6
+
+        later = self.db.eventsSince(events[2].seq, list_a)
+        assert [e.seq for e in later] == [e.seq for e in events[3:]]
+        assert not self.db.eventsSince(0, list_b)
+
+    def test_friend_unread(self):
+        """Followers count the changed items until their next visit."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        self.db.addToFriend(user_b, list_a)
+        assert self.db.getFriendLists(user_b) == [(list_a, 0)]
+
+        item_id = self.db.addNewItem(list_a, 'foo', 'foo', 'foo')
+        self.db.addNewItem(list_a, 'bar', 'bar', 'bar')
+        item = self.db.getListItem(list_a, item_id)
+        self.db.editItem(item, 'baz', 'baz', 'baz', 1)
+        assert self.db.getFriendLists(user_b) == [(list_a, 3)]
+
+        self.db.addToFriend(user_b, list_a)
+        assert self.db.getFriendLists(user_b) == [(list_a, 0)]
+
+    def test_items_page(self):
+        """Items are returned one page at a time, in display order."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        for i in range(7):
+            self.db.addNewItem(list_a, 'item %d' % i, '', '')
+        everything = [i.key for i in self.db.itemsForList(list_a)]
+
+        keys, after = [], None
+        while True:
+            items, after = self.db.itemsForListPage(list_a, after, 3)
+            keys += [i.key for i in items]
+            if after is None:
+                break
+        assert sorted(keys) == sorted(everything)
+        assert len(keys) == 7
+
+        # Items reserved by others are skipped for the simple users
+        item = self.db.getListItem(list_a, keys[0])
+        self.db.reserveItem(user_b, item)
+        items, _ = self.db.itemsForListPage(list_a, None, 10, True,
+                                            hide_reserved=True)
+        assert len(items) == 6
+        items, _ = self.db.itemsForListPage(list_a, None, 10, True,
+                                            hide_reserved=True,
+                                            viewer=user_b.id)
+        assert len(items) == 7
+        assert items[0].res[:2] == (user_b.id, 'R')
+
+    def test_items_page_no_score(self):
+        """Items with no score come last, and the cursor goes past them."""
+        user_a, list_a = self.create_user_and_list(u'a')
+
+        for i in range(5):
+            self.db.addNewItem(list_a, 'item %d' % i, '', '')
+        self.db.cx.execute('UPDATE item SET score = NULL WHERE key IN'
+                           ' (SELECT key FROM item WHERE list = ? LIMIT 3)',
+                           (list_a.id,))
+        self.db.cx.commit()
+
+        keys, after = [], None
+        while True:
+            items, after = self.db.itemsForListPage(list_a, after, 2)
+            keys += [i.key for i in items]
+            if after is None:
+                break
+            after = web.parse_cursor(web.format_cursor(after))
+        assert len(keys) == 5 and len(set(keys)) == 5
+        scores = [self.db.getListItem(list_a, k).score for k in keys]
+        assert scores[-3:] == [None] * 3
+
+    def test_reservation_lists(self):
+        """The lists where a user reserved items."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        assert self.db.getUserReservationLists(user_b) == []
+        for title in ('un', 'deux'):
+            item = self.db.getListItem(list_a, self.db.addNewItem(
+                list_a, title, '', ''))
+            self.db.reserveItem(user_b, item)
+        assert self.db.getUserReservationLists(user_b) == [list_a.id]
+
+        self.db.giveupItem(user_b, item)
+        assert len(self.db.getUserReservations(user_b)) == 1
+
+    def test_items_for_viewer(self):
+        """Only the managers of a list know who reserved what."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+        user_c, list_c = self.create_user_and_list(u'c')
+
+        item = self.db.getListItem(
+            list_a, self.db.addNewItem(list_a, 'foo', 'foo', 'foo'))
+        self.db.addNewItem(list_a, 'bar', 'bar', 'bar')
+        self.db.reserveItem(user_b, item)
+
+        # The owner does not see the reservations, unless asked to
+        items, _ = self.db.itemsForViewer(list_a, user_a)
+        assert len(items) == 2
+        assert not [i for i in items if i.res]
+
+        self.db.updateList(list_a, showres=True)
+        list_a = self.db.getListByKey(list_a.id)
+        items, _ = self.db.itemsForViewer(list_a, user_a)
+        assert [i.res for i in items if i.res] == [
+            (user_b.id, 'R', 'b@foo.com')]
+
+        # The others do not see who reserved
+        items, _ = self.db.itemsForViewer(list_a, user_b)
+        assert [i.res for i in items if i.res] == [(user_b.id, 'R', None)]
+        items, _ = self.db.itemsForViewer(list_a, user_c)
+        assert len(items) == 1
+        items, _ = self.db.itemsForViewer(list_a, None)
+        assert len(items) == 1
+
+    def test_import_items(self):
+        """Imported items are added in a single transaction."""
+        user_a, list_a = self.create_user_and_list(u'a')
+
+        statements = self.db.sql_statements
+        count = self.db.importItems(list_a, [
+            (u'foo', u'', u'', 1), (u'bar', u'bar', u'', 3)])
+        assert count == 2
+        assert self.db.sql_statements == statements + 1
+
+        items = self.db.itemsForList(list_a)
+        assert [i.title for i in items] == [u'bar', u'foo']
+
+    def test_export(self):
+        """The export holds the user's lists, items and reservations."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        self.db.addNewItem(list_a, u'foo', u'', u'')
+        item = self.db.getListItem(
+            list_b, self.db.addNewItem(list_b, u'bar', u'', u''))
+        self.db.reserveItem(user_a, item)
+
+        cx = self.db.connect()
+        try:
+            recs = list(export.records(cx, user_a))
+            text = ''.join(export.json_chunks(iter(recs)))
+            lines = ''.join(export.csv_chunks(iter(recs))).splitlines()
+        finally:
+            cx.close()
+
+        assert [(r['type'], r['list']) for r in recs] == [
+            ('list', list_a.url), ('item', list_a.url),
+            ('reservation', list_b.url)]
+        assert json.loads(text) == recs
+        assert len(lines) == 4
+
+    def test_backup(self):
+        """Backups are complete copies, and only the last ones are kept."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        backups = backup.Backup('+backups-test', keep=2)
+        os.mkdir(backups.directory)
+        try:
+            for n in range(3):
+                path = os.path.join(backups.directory,
+                                    backups.PREFIX + '%d.db' % n)
+                assert backups._copy(path) > 0
+                backups._rotate()
+
+            assert [os.path.basename(p) for p in backups.snapshots()] == [
+                backups.PREFIX + '1.db', backups.PREFIX + '2.db']
+
+            cx = core.sqlite.connect(path)
+            assert cx.execute('SELECT name FROM wishlist WHERE key = ?',
+                              (list_a.id,)).fetchone()[0] == u'a'
+            cx.close()
+        finally:
+            shutil.rmtree(backups.directory)
+
+    def test_backup_at_start(self):
+        """A backup is made at start when the last one is too old."""
+        backups = backup.Backup('+backups-test', period=3600)
+        runs = []
+        backups.run = lambda: runs.append(1)
+        try:
+            backups.startService()
+            backups.stopService()
+            assert runs == [1]
+
+            path = os.path.join(backups.directory, backups.PREFIX + '1.db')
+            open(path, 'w').close()
+            backups.startService()
+            backups.stopService()
+            assert runs == [1]
+
+            os.utime(path, (0, 0))
+            backups.startService()
+            backups.stopService()
+            assert runs == [1, 1]
+        finally:
+            shutil.rmtree(backups.directory)
+
+    def test_search(self):
+        """Search the lists a user owns or follows."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+        user_c, list_c = self.create_user_and_list(u'c')
+
+        self.db.updateList(list_b, title=u'Noël de Bob')
+        self.db.addNewItem(list_a, u'Un vélo rouge', u'', u'')
+        self.db.addNewItem(list_b, u'Un vélo bleu', u'Pour la route', u'')
+        reserved = self.db.getListItem(list_b, self.db.addNewItem(
+            list_b, u'Un vélo vert', u'', u''))
+        self.db.addNewItem(list_c, u'Un vélo jaune', u'', u'')
+        self.db.reserveItem(user_c, reserved)
+
+        self.db.addToFriend(user_a, list_b)
+
+        titles = [i.title for i, _, _ in self.db.searchItems(user_a, u'VÉLO')]
+        assert sorted(titles) == [u'Un vélo bleu', u'Un vélo rouge']
+
+        found = self.db.searchItems(user_a, u'rou')
+        assert [i.title for i, _, _ in found] == [u'Un vélo rouge',
+                                                 u'Un vélo bleu']
+        assert core.SNIPPET_START + u'route' in found[1][2]
+
+        titles = [i.title for i, _, _ in self.db.searchItems(user_b, u'vélo')]
+        assert sorted(titles) == [u'Un vélo bleu', u'Un vélo vert']
+
+        assert self.db.searchLists(user_a, u'noel') == [list_b]
+        assert self.db.searchLists(user_c, u'noel') == []
+        assert self.db.searchItems(user_a, u'"*') == []
+
+    def test_claims(self):
+        """Reservations are decided in memory and written in batches."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, _ = self.create_user_and_list(u'b')
+        user_c, _ = self.create_user_and_list(u'c')
+
+        item = self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, u'foo', u'', u''))
+        other = self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, u'bar', u'', u''))
+
+        claims = self.db.claims
+        assert claims.reserve(user_b, item)
+
+        statements = self.db.sql_statements
+        assert not claims.reserve(user_c, item)
+        assert claims.reserve(user_b, item)
+        assert self.db.sql_statements == statements
+        assert self.db.reservationHolder(item) is None
+
+        # Another process reserves the second item in between
+        assert claims.reserve(user_b, other)
+        cx = self.db.connect()
+        cx.execute("INSERT INTO reservation (item, owner, status)"
+                   " VALUES (?, ?, 'R')", (other.key, user_c.id))
+        cx.commit()
+        cx.close()
+
+        claims.flush()
+        assert self.db.reservationHolder(item) == user_b.id
+        assert self.db.reservationHolder(other) == user_c.id
+        assert not claims.reserve(user_b, other)
+
+        # Giving up is seen by the next claim
+        assert not claims.reserve(user_c, item)
+        self.db.giveupItem(user_b, item)
+        assert claims.reserve(user_c, item)
+        self.db.giveupItem(user_c, item)
+        assert self.db.reservationHolder(item) is None
+
+    def test_claims_losers(self):
+        """The losers are turned down from memory, batch after batch."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, _ = self.create_user_and_list(u'b')
+        user_c, _ = self.create_user_and_list(u'c')
+        user_d, _ = self.create_user_and_list(u'd')
+
+        first, second = [self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, title, u'', u'')) for title in (u'foo', u'bar')]
+        claims = self.db.claims
+
+        def cost(user, item):
+            statements = self.db.sql_statements
+            assert not claims.reserve(user, item)
+            return self.db.sql_statements - statements
+
+        assert claims.reserve(user_b, first)
+        claims.flush()
+        assert cost(user_c, first) == 1
+        assert cost(user_d, first) == 0
+
+        # The second batch bumps the list again: it is read once more
+        assert claims.reserve(user_b, second)
+        claims.flush()
+        assert cost(user_c, second) == 1
+        assert cost(user_d, second) == 0
+        assert cost(user_c, first) == 0
+
+        self.db.giveupItem(user_b, first)
+        self.db.giveupItem(user_b, second)
+
+    def test_claims_written(self):
+        """The users are told about a claim once it is written."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, _ = self.create_user_and_list(u'b')
+        user_c, _ = self.create_user_and_list(u'c')
+
+        item = self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, u'foo', u'', u''))
+        claims = self.db.claims
+
+        results = []
+        assert claims.reserve(user_b, item)
+        claims.written(item).addCallback(results.append)
+        assert results == []
+        claims.flush()
+        assert results == [True]
+        claims.written(item).addCallback(results.append)
+        assert results == [True, True]
+        self.db.giveupItem(user_b, item)
+
+        # A failed write is reported, and forgotten by the claims
+        def _locked(claims):
+            raise core.sqlite.OperationalError('database is locked')
+        self.db.persistReservations = _locked
+        errors = []
+        try:
+            assert claims.reserve(user_b, item)
+            claims.written(item).addErrback(errors.append)
+            claims.flush()
+        finally:
+            del self.db.persistReservations
+        assert len(errors) == 1
+        assert self.db.reservationHolder(item) is None
+
+        assert claims.reserve(user_c, item)
+        claims.flush()
+        assert self.db.reservationHolder(item) == user_c.id
+        self.db.giveupItem(user_c, item)
+
+    def test_sidebar(self):
+        """The sidebar is cached until the lists it shows change."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        self.db.addToFriend(user_a, list_b)
+        mine, friends = self.db.getSidebar(user_a)
+        assert [l.id for l, _ in mine] == [list_a.id]
+        assert [(l.id, n) for l, n in friends] == [(list_b.id, 0)]
+
+        statements = self.db.sql_statements
+        assert self.db.getSidebar(user_a) == (mine, friends)
+        assert self.db.sql_statements == statements
+
+        # A change in a followed list
+        self.db.addNewItem(list_b, u'foo', u'', u'')
+        assert self.db.getSidebar(user_a)[1][0][1] == 1
+
+        # A visit resets the count
+        self.db.addToFriend(user_a, list_b)
+        assert self.db.getSidebar(user_a)[1][0][1] == 0
+
+        # A new list, another user following a list
+        list_c = self.db.createList(user_a, u'c')
+        self.db.addToFriend(user_b, list_a)
+        assert len(self.db.getSidebar(user_a)[0]) == 2
+
+        self.db.remove_from_friend(user_a, list_b)
+        assert self.db.getSidebar(user_a)[1] == []
+        self.db.destroyList(list_c)
+        assert len(self.db.getSidebar(user_a)[0]) == 1
+
+    def test_counters(self):
+        """The counters of the lists follow the changes."""
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, list_b = self.create_user_and_list(u'b')
+
+        items = [self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, u'item %d' % i, u'', u'')) for i in range(4)]
+        self.db.reserveItem(user_b, items[0])
+        self.db.reserveItem(user_b, items[1])
+        self.db.donatedItem(user_b, items[1])
+        self.db.reserveItem(user_b, items[2])
+        self.db.giveupItem(user_b, items[2])
+        self.db.addToFriend(user_b, list_a)
+
+        assert self.db.listCounters(list_a) == {
+            'items': 4, 'reserved': 1, 'donated': 1, 'followers': 1}
+
+        self.db.deleteItem(items[0], warn=False)
+        self.db.deleteItem(items[1], warn=False)
+        self.db.remove_from_friend(user_b, list_a)
+        assert self.db.listCounters(list_a) == {
+            'items': 2, 'reserved': 0, 'donated': 0, 'followers': 0}
+        assert self.db.repairCounters() == 0
+
+        # A change made behind the back of the triggers
+        self.db.cx.execute('UPDATE wishlist SET items = 10')
+        self.db.cx.commit()
+        assert self.db.repairCounters() == 2
+        assert self.db.listCounters(list_a)['items'] == 2
+        assert self.db.listCounters(list_b)['items'] == 0
+
+    def test_gc_repair(self):
+        """The counters are repaired by the periodic GC, not the first."""
+        repairs = []
+        self.db.repairCounters = lambda: repairs.append(1)
+        try:
+            self.db.gc_call.cancel()
+            self.db._startGC()
+            assert repairs == []
+            self.db.garbageCollector()
+            assert repairs == [1]
+        finally:
+            del self.db.repairCounters
+
+    def test_daily_stats(self):
+        """The statistics of the day are counted as things happen."""
+        def today():
+            by_day, totals = self.db.dailyStats()
+            if by_day:
+                return by_day[0][1], totals
+            return {}, totals
+
+        before, totals = today()
+        user_a, list_a = self.create_user_and_list(u'a')
+        user_b, _ = self.create_user_and_list(u'b')
+
+        item = self.db.getListItem(list_a, self.db.addNewItem(
+            list_a, u'foo', u'', u''))
+        self.db.reserveItem(user_b, item)
+        assert self.db.donatedItem(user_b, item)
+
+        # Only the counted statistics change: the ones set by the
+        # maintenance, like the size of the database, stay as they are.
+        after, _ = today()
+        delta = dict((name, value - before.get(name, 0))
+                     for name, value in after.items()
+                     if value != before.get(name, 0))
+        assert delta == {
+            'sessions_active': 2, 'users_created': 2, 'users_identified': 2,
+            'lists_created': 2, 'items_created': 1, 'reservations': 1,
+            'donations': 1, 'challenges': 2, 'mails': 3}
+        assert today()[1] == totals
+
+        self.db.pretend_email_address(user_a, u'other@foo.com')
+        assert today()[1]['challenges_pending'] == \
+            totals['challenges_pending'] + 1
+
+    def test_challenge_pending_null(self):
+        """A challenge inserted without 'active' is counted as pending."""
+        def pending():
+            return self.db.dailyStats()[1]['challenges_pending']
+
+        before = pending()
+        self.db.cx.execute('INSERT INTO challenge (challenge, session, email,'
+                           ' user) VALUES (?, ?, ?, ?)',
+                           ('null', 's', 'null@foo.com', 1))
+        self.db.cx.commit()
+        assert pending() == before + 1
+
+        self.db.cx.execute('DELETE FROM challenge WHERE challenge = ?',
+                           ('null',))
+        self.db.cx.commit()
+        assert pending() == before
@@ -16,7 +16,10 @@
 # with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
 import uts
 
+from nevow import flat, tags as T
+
 from souhaits import format
+from souhaits.web import theme, widget
 
 class TestFormat(object):
 
@@ -52,3 +55,40 @@ bon
         assert link.tagName == 'a'
         assert link.attributes['href'] == url
         assert link.children [0] == 'http://www.king-jouet33.com/...'
+
+
+class TestFlatTemplate(object):
+
+    def testEscape(self):
+        tpl = widget.FlatTemplate(
+            T.img(alt=widget.HOLE)[T.h1[widget.HOLE]])
+        data = u'<b>caf\xe9 & co</b>'
+        expected = flat.flatten(T.img(alt=data)[T.h1[data]])
+        assert flat.flatten(tpl.fill(data)) == expected
+
+    def testThemes(self):
+        for t in theme.themes.values():
+            for part in (t.render_Lock(None, 'a<b'),
+                         t.render_ListTitle(None, 'a<b')):
+                html = flat.flatten(part)
+                assert 'a&lt;b' in html
+                assert widget.HOLE not in html
+
+
+class TestWidget(object):
+
+    def testStars(self):
+        assert flat.flatten(widget.stars(2)).count('star-on') == 2
+        assert flat.flatten(widget.stars(2)).count('star-off') == 1
+        assert widget.stars(3) is widget.stars(3)
+
+    def testCompiledBox(self):
+        plain = widget.RoundedBoxMixin()
+        plain.compiled = False
+        compiled = widget.RoundedBoxMixin()
+        for padding in (True, False):
+            tag = T.div(_class="editable", id="x")[T.p[u'caf\xe9 <']]
+            expected = flat.flatten(plain._make_fragment(tag, padding))
+            tag = T.div(_class="editable", id="x")[T.p[u'caf\xe9 <']]
+            assert flat.flatten(compiled._make_fragment(tag, padding)) == \
+                expected
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+import uts
+
+from souhaits import importer
+
+class TestImporter(object):
+
+    def testCSV(self):
+        items, errors = importer.parse('''\
+titre,description,lien,score
+Un vélo,rouge,http://example.com/velo,3
+"Un livre, gros",,,
+,,,
+Rien,,,5
+''')
+        assert items == [
+            (u'Un v\xe9lo', u'rouge', u'http://example.com/velo', 3),
+            (u'Un livre, gros', u'', u'', 2)]
+        assert [e[0] for e in errors] == [5]
+
+    def testJSON(self):
+        items, errors = importer.parse('''[
+          {"title": "Un train", "score": "1"},
+          {"description": "sans titre", "url": "http://example.com"},
+          {},
+          "texte",
+          {"title": 12}
+        ]''')
+        assert items == [(u'Un train', u'', u'', 1),
+                         (u'', u'sans titre', u'http://example.com', 2)]
+        assert [e[0] for e in errors] == [3, 4, 5]
+
+    def testInvalidJSON(self):
+        items, errors = importer.parse('[{"title": ')
+        assert items == []
+        assert len(errors) == 1
@@ -0,0 +1,98 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+import uts
+
+from twisted.internet import defer, task
+
+from souhaits import core, maintenance, metrics, schema
+
+
+class TestMaintenance(object):
+
+    def setup_method(self, method):
+        uts.resetDB()
+        self.db = core.Service('http://localhost:7707', debug=True,
+                               background=False)
+        self.db.startService()
+        self.clock = task.Clock()
+        self.maintenance = maintenance.Maintenance(self.db, clock=self.clock)
+
+    def teardown_method(self, method):
+        self.db.stopService()
+
+    def pragma(self, name):
+        return self.db.cx.execute('PRAGMA %s' % name).fetchone()[0]
+
+    def test_incremental(self):
+        """The maintenance converts the database, not the start."""
+        isolation_level = self.db.cx.isolation_level
+        self.db.cx.isolation_level = None
+        self.db.cx.execute('PRAGMA auto_vacuum = NONE')
+        self.db.cx.execute('VACUUM')
+        self.db.cx.isolation_level = isolation_level
+        assert self.pragma('auto_vacuum') == 0
+
+        self.db.stopService()
+        self.db.startService()
+        assert self.pragma('auto_vacuum') == 0
+
+        # The conversion runs in a thread: here, at once
+        deferToThread = maintenance.threads.deferToThread
+        maintenance.threads.deferToThread = defer.maybeDeferred
+        try:
+            done = []
+            self.maintenance.run(force=True).addCallback(done.append)
+        finally:
+            maintenance.threads.deferToThread = deferToThread
+        assert done == [True]
+        assert self.maintenance.converting is None
+        assert self.pragma('auto_vacuum') == schema.AUTO_VACUUM_INCREMENTAL
+
+    def test_vacuum(self):
+        # The free pages are only given back once converted
+        assert self.maintenance._convert()
+
+        user, _ = self.db.createSessionUser()
+        lst = self.db.createList(user, u'grosse liste')
+        self.db.importItems(lst, [(u'souhait %d' % i, u'x' * 2000, u'', 2)
+                                  for i in range(500)])
+        self.db.destroyList(lst)
+        free = self.pragma('freelist_count')
+        assert free > 2 * self.maintenance.PAGES_PER_STEP
+
+        done = []
+        self.maintenance.run(force=True).addCallback(done.append)
+        assert not done
+        assert self.pragma('freelist_count') < free
+
+        while not done:
+            self.clock.advance(self.maintenance.STEP_PAUSE)
+
+        assert self.pragma('freelist_count') == 0
+        assert metrics.DB_FREE_RATIO.values[()] == 0
+        assert self.db.cx.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()[0] == 1
+
+        by_day, _ = self.db.dailyStats(1)
+        assert by_day[0][1]['db_kbytes'] > 0
+        assert by_day[0][1]['db_free_percent'] == 0
+
+    def test_window(self):
+        self.maintenance.window = (25, 25)
+        self.maintenance.run()
+        assert self.maintenance.pending is None
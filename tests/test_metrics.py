@@ -0,0 +1,60 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+import uts
+
+from souhaits import metrics
+
+class TestMetrics(object):
+
+    def test_counter(self):
+        c = metrics.Counter('hits_total', 'Hits.', ['page'])
+        c.inc('List')
+        c.inc('List', amount=2)
+        c.inc('Invite')
+
+        lines = c.render().split('\n')
+        assert lines[0] == '# HELP hits_total Hits.'
+        assert lines[1] == '# TYPE hits_total counter'
+        assert 'hits_total{page="List"} 3' in lines
+        assert 'hits_total{page="Invite"} 1' in lines
+
+    def test_histogram(self):
+        h = metrics.Histogram('lat_seconds', 'Latency.', buckets=(0.1, 1))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+
+        lines = h.render().split('\n')
+        assert 'lat_seconds_bucket{le="0.1"} 1' in lines
+        assert 'lat_seconds_bucket{le="1"} 2' in lines
+        assert 'lat_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'lat_seconds_sum 5.55' in lines
+        assert 'lat_seconds_count 3' in lines
+
+    def test_label_escaping(self):
+        c = metrics.Counter('x_total', 'X.', ['cache'])
+        c.inc('a"b')
+        assert 'x_total{cache="a\\"b"} 1' in c.render()
+
+    def test_wrong_labels(self):
+        c = metrics.Counter('x_total', 'X.', ['cache', 'result'])
+        try:
+            c.inc('only-one')
+        except ValueError:
+            pass
+        else:
+            assert False, 'missing label accepted'
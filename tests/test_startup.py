@@ -0,0 +1,39 @@
+# This file is part of Mes-Souhaits.
+#
+# Copyright (c) 2016 Frederic Gobry
+#
+# Mes-Souhaits is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Mes-Souhaits is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with Mes-Souhaits. If not, see: <http://www.gnu.org/licenses/>.
+import uts
+
+from souhaits import startup, web
+
+
+class TestStartup(object):
+
+    def test_phases(self):
+        phases = startup.Phases(0)
+        phases.mark('imports')
+        phases.mark('database')
+        assert [name for name, _ in phases.durations] == [
+            'imports', 'database']
+
+        phases.report()
+        phases.mark('later')
+        assert len(phases.durations) == 2
+
+    def test_templates(self):
+        web.load_templates()
+        assert web.template('site.xml') is web.template('site.xml')
+        assert web.template('site.xml').load() is \
+            web.template('site.xml').load()